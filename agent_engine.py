@@ -1,10 +1,12 @@
 # agent_engine.py
 
-from llm_api import LLM_API_MAP
+from llm_api import LLM_API_MAP, history_token_budget, agenerate_streamed
 from utils import debug_print # Import debug_print
+from state_tracker import ChatPrompt, render_history_messages
+from telemetry import call_context
 
 class AgentEngine:
-    def __init__(self, configs, conversation_mode=False):
+    def __init__(self, configs, conversation_mode=False, max_history_tokens=4000):
         self.agents = {}
         for config in configs:
             self.agents[config['name']] = {
@@ -13,8 +15,15 @@ class AgentEngine:
                 'response_length': config.get('response_length', 'medium') # Get response_length from config
             }
         self.conversation_mode = conversation_mode
+        self.max_history_tokens = max_history_tokens
 
-    def get_agent_response(self, agent_name, topic, history, max_history_tokens=4000):
+    def recent_history(self, agent_name, state_tracker):
+        """Returns the history window sized for the context window of the agent's model."""
+        agent_info = self.agents[agent_name]
+        budget = history_token_budget(agent_info['model_key'], agent_info['response_length'], self.max_history_tokens)
+        return state_tracker.get_recent_history(max_tokens=budget, model_key=agent_info['model_key'], use_summary=True)
+
+    def _prepare_request(self, agent_name, topic, history):
         agent_info = self.agents.get(agent_name)
         if not agent_info:
             raise ValueError(f"Agent {agent_name} not found.")
@@ -26,35 +35,39 @@ class AgentEngine:
         llm_client = LLM_API_MAP[model_key]['client']
         model_name_for_api = LLM_API_MAP[model_key]['model_name_for_api']
 
-        # Construct the prompt for the agent
-        # This prompt should include the persona, topic, and discussion history
-        recent_history = history # history is already recent history from main.py
-        history_text = "\n".join([f"{item['speaker']}: {item['text']}" for item in recent_history])
-        
+        # Fixed system prefix (persona, rules, topic) followed by the history as
+        # append-only messages, so consecutive turns share a cacheable prefix.
+        # The client adds the length instruction at the end of the system prefix.
         if self.conversation_mode:
-            prompt = f"""
-あなたは{persona}という立場のAIです。以下の主題とこれまでの会話内容を踏まえて、直前の発言に反応しつつ、あなたの意見を自然な会話の流れで述べてください。非常にフランクに、短い言葉で返してください。必ずしも完璧な意見を述べる必要はありません。考えがまとまっていなくても、率直な感想を述べてください。「うーん」「どうかな」「あんまり考えたことない」といった表現も使って構いません。一言、二言で終わっても構いません。簡潔に、対話的に応答することを心がけてください。
+            system = f"""あなたは{persona}という立場のAIです。以下の主題とこれまでの会話内容を踏まえて、直前の発言に反応しつつ、あなたの意見を自然な会話の流れで述べてください。非常にフランクに、短い言葉で返してください。必ずしも完璧な意見を述べる必要はありません。考えがまとまっていなくても、率直な感想を述べてください。「うーん」「どうかな」「あんまり考えたことない」といった表現も使って構いません。一言、二言で終わっても構いません。簡潔に、対話的に応答することを心がけてください。
 
 主題: {topic}
 
-これまでの会話:
-{history_text}
-
-あなたの発言:
-"""
+これまでの会話は「発言者: 内容」の形式で続きます。"""
         else:
-            prompt = f"""
-あなたは{persona}という立場のAIです。以下の主題とこれまでの討論内容を踏まえて、あなたの意見を述べてください。
+            system = f"""あなたは{persona}という立場のAIです。以下の主題とこれまでの討論内容を踏まえて、あなたの意見を述べてください。
 
 主題: {topic}
 
-これまでの討論:
-{history_text}
+これまでの討論は「発言者: 内容」の形式で続きます。"""
+        messages = render_history_messages(history)
+        messages.append({"role": "user", "content": f"{agent_name}として、あなたの発言:"})
+        prompt = ChatPrompt(system, messages)
 
-あなたの発言:
-"""
-        
-        # In a real scenario, call the appropriate LLM API here
         debug_print(f"[DEBUG] Calling LLM for {agent_name} with model {model_key} ({model_name_for_api}), length {response_length}")
-        response = llm_client.generate(prompt, model_name_for_api, response_length)
+        return llm_client, prompt, model_name_for_api, response_length
+
+    def get_agent_response(self, agent_name, topic, history, max_history_tokens=4000):
+        llm_client, prompt, model_name_for_api, response_length = self._prepare_request(agent_name, topic, history)
+        with call_context(role="agent", speaker=agent_name):
+            response = llm_client.generate(prompt, model_name_for_api, response_length)
+        return response
+
+    async def aget_agent_response(self, agent_name, topic, history, max_history_tokens=4000, on_chunk=None):
+        """Async variant of get_agent_response. If on_chunk is given the response is streamed to it."""
+        llm_client, prompt, model_name_for_api, response_length = self._prepare_request(agent_name, topic, history)
+        with call_context(role="agent", speaker=agent_name):
+            if on_chunk is not None:
+                return await agenerate_streamed(llm_client, prompt, model_name_for_api, response_length, on_chunk)
+            response = await llm_client.agenerate(prompt, model_name_for_api, response_length)
         return response
@@ -0,0 +1,98 @@
+# batch_runner.py
+
+import asyncio
+import time
+
+import llm_api
+from moderator_engine import ModeratorEngine
+from agent_engine import AgentEngine
+from state_tracker import StateTracker
+from debate_runner import run_debate
+from telemetry import call_context
+from utils import debug_print
+
+def load_batch_jobs(batch_config, default_rounds):
+    """Normalizes a batch file into a list of job dicts.
+
+    The batch file is YAML with a `debates:` list (or a bare list). Each entry is
+    either a topic string or a mapping with `topic` and optional `rounds` and
+    `agents` (a list in the same format as agents.yaml, replacing the default agents).
+    """
+    entries = batch_config.get('debates', []) if isinstance(batch_config, dict) else batch_config
+    jobs = []
+    for index, entry in enumerate(entries or []):
+        if isinstance(entry, str):
+            entry = {'topic': entry}
+        if 'topic' not in entry:
+            raise ValueError(f"Batch entry {index} has no topic.")
+        jobs.append({
+            'index': index,
+            'topic': entry['topic'],
+            'rounds': int(entry.get('rounds', default_rounds)),
+            'agents': entry.get('agents'),
+        })
+    return jobs
+
+async def _run_job(job, agents_config, summarize_rounds, conversation_mode, log_dir):
+    moderator_config = agents_config['moderator']
+    agent_configs = job['agents'] or agents_config['agents']
+
+    moderator_engine = ModeratorEngine(moderator_config, conversation_mode)
+    agent_engine = AgentEngine(agent_configs, conversation_mode)
+    state_tracker = StateTracker(log_dir=log_dir, token_counters=llm_api.model_token_counters())
+    state_tracker.start_log(job['topic'], suffix=f"{job['index']:04d}")
+
+    try:
+        with call_context(debate=job['index']):
+            await run_debate(
+                job['topic'], job['rounds'], moderator_engine, agent_engine, state_tracker,
+                moderator_config, agent_configs, summarize_rounds=summarize_rounds, echo=False
+            )
+    finally:
+        state_tracker.save_logs(job['topic'])
+
+async def run_batch(jobs, agents_config, workers=4, summarize_rounds=False,
+                    conversation_mode=False, log_dir='logs'):
+    """Runs debates on a pool of `workers` concurrent tasks.
+
+    All jobs share the clients in llm_api.LLM_API_MAP, so initialize_llm_api_map
+    must be called once beforehand. Returns a stats dict for print_batch_report.
+    """
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    stats = {'completed': 0, 'failed': 0}
+    calls_before = sum(llm_api.PROVIDER_CALL_COUNTS.values())
+    started_at = time.perf_counter()
+
+    async def worker(worker_id):
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            debug_print(f"[worker {worker_id}] starting debate {job['index']}: {job['topic']}")
+            try:
+                await _run_job(job, agents_config, summarize_rounds, conversation_mode, log_dir)
+                stats['completed'] += 1
+                print(f"[{stats['completed'] + stats['failed']}/{len(jobs)}] Finished: {job['topic']}")
+            except Exception as e:
+                stats['failed'] += 1
+                print(f"[{stats['completed'] + stats['failed']}/{len(jobs)}] Failed: {job['topic']} ({e})")
+
+    await asyncio.gather(*(worker(i) for i in range(max(1, min(workers, len(jobs))))))
+
+    stats['elapsed'] = time.perf_counter() - started_at
+    stats['calls'] = sum(llm_api.PROVIDER_CALL_COUNTS.values()) - calls_before
+    return stats
+
+def print_batch_report(stats):
+    minutes = max(stats['elapsed'], 1e-9) / 60
+    print("\n--- Batch Report ---")
+    print(f"Debates completed: {stats['completed']} (failed: {stats['failed']})")
+    print(f"Elapsed: {stats['elapsed']:.1f}s")
+    print(f"Throughput: {stats['completed'] / minutes:.2f} debates/min, {stats['calls'] / minutes:.2f} calls/min")
+    for api_type, count in sorted(llm_api.PROVIDER_CALL_COUNTS.items()):
+        print(f"  {api_type}: {count} calls")
+    print("--------------------")
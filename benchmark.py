@@ -0,0 +1,311 @@
+# benchmark.py
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import yaml
+
+import llm_api
+from llm_api import initialize_llm_api_map, get_api_client, LLM_API_MAP
+from moderator_engine import ModeratorEngine
+from agent_engine import AgentEngine
+from state_tracker import StateTracker
+from debate_runner import run_debate
+
+BENCHMARK_TOPIC = "ベンチマーク用の討論テーマ"
+BENCHMARK_MODEL_KEY = "mock"
+
+# Scenario parameters and their defaults when config/benchmark.yaml has no `base:`
+DEFAULT_SCENARIO = {
+    "agents": 3,
+    "rounds": 10,
+    "history_budget": 4000,
+    "response_length": "medium",
+    "summarize_rounds": False,
+    "panel": False,
+}
+
+# Metrics compared against the baseline: (path in the result, True if higher is better)
+COMPARED_METRICS = [
+    (("rounds_per_sec",), True),
+    (("cpu_ms_per_round",), False),
+    (("peak_memory_kb",), False),
+    (("prompt_tokens", "max"), False),
+    (("stages", "moderator", "p90"), False),
+    (("stages", "agent", "p90"), False),
+    (("stages", "summary", "p90"), False),
+]
+
+def load_benchmark_config(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
+
+def expand_scenarios(config):
+    """The base scenario plus one scenario per sweep value, varying one parameter at a time.
+
+    One-at-a-time keeps the number of runs linear in the sweep size; a full grid
+    of agents x rounds x budget x length would take hours with realistic latencies.
+    """
+    base = dict(DEFAULT_SCENARIO)
+    base.update(config.get('base') or {})
+    scenarios = [dict(base, name="base")]
+    for parameter, values in (config.get('sweep') or {}).items():
+        if parameter not in DEFAULT_SCENARIO:
+            raise ValueError(f"Unknown sweep parameter '{parameter}'. Available: {', '.join(DEFAULT_SCENARIO)}")
+        for value in values:
+            if value == base[parameter]:
+                continue
+            scenarios.append(dict(base, name=f"{parameter}={value}", **{parameter: value}))
+    return scenarios
+
+def make_agent_configs(count, model_key, response_length):
+    agents = []
+    for index in range(count):
+        name = f"AI-{chr(ord('A') + index)}" if index < 26 else f"AI-{index}"
+        agents.append({
+            'name': name,
+            'model': model_key,
+            'persona': f"視点{index + 1}から意見を述べるAI",
+            'response_length': response_length,
+        })
+    return agents
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def _instrument(obj, method_name, stage, stage_times):
+    """Replaces an async method on `obj` with one that records its latency under `stage`."""
+    method = getattr(obj, method_name)
+
+    async def timed(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            stage_times.setdefault(stage, []).append(time.perf_counter() - started_at)
+
+    setattr(obj, method_name, timed)
+
+async def run_scenario(scenario, mock_settings, log_dir):
+    """Runs one debate against the mock provider and returns its metrics."""
+    # Reseeding the mock per scenario makes runs with the same config comparable
+    get_api_client("mock").configure(mock_settings)
+    token_counter = LLM_API_MAP[BENCHMARK_MODEL_KEY]['token_counter']
+
+    agent_configs = make_agent_configs(scenario['agents'], BENCHMARK_MODEL_KEY, scenario['response_length'])
+    moderator_config = {
+        'name': "Moderator",
+        'model': BENCHMARK_MODEL_KEY,
+        'persona': "公正な司会者",
+        'response_length': scenario['response_length'],
+    }
+    moderator_engine = ModeratorEngine(moderator_config, max_history_tokens=scenario['history_budget'])
+    agent_engine = AgentEngine(agent_configs, max_history_tokens=scenario['history_budget'])
+    state_tracker = StateTracker(log_dir=log_dir, token_counters=llm_api.model_token_counters())
+
+    stage_times = {}
+    _instrument(moderator_engine, 'adecide_next_speaker', 'moderator', stage_times)
+    _instrument(moderator_engine, 'apose_panel_question', 'moderator', stage_times)
+    _instrument(moderator_engine, 'aupdate_summary', 'summary', stage_times)
+    _instrument(agent_engine, 'aget_agent_response', 'agent', stage_times)
+
+    # Agent prompt size per call, to see how prompts grow with the history
+    prompt_tokens = []
+    prepare_request = agent_engine._prepare_request
+
+    def measured_prepare_request(agent_name, topic, history):
+        request = prepare_request(agent_name, topic, history)
+        prompt_tokens.append(token_counter.count(request[1]))
+        return request
+
+    agent_engine._prepare_request = measured_prepare_request
+
+    scheduler_before = dict(llm_api.SCHEDULER.stats)
+    prompt_before, cached_before = _prompt_token_totals()
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    await run_debate(
+        BENCHMARK_TOPIC, scenario['rounds'], moderator_engine, agent_engine, state_tracker,
+        moderator_config, agent_configs, summarize_rounds=scenario['summarize_rounds'], echo=False,
+        panel=scenario['panel']
+    )
+    wall_seconds = time.perf_counter() - started_at
+    cpu_seconds = time.process_time() - cpu_started_at
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    prompt_total, cached_total = _prompt_token_totals()
+    prompt_total -= prompt_before
+    cached_total -= cached_before
+
+    stages = {}
+    for stage, times in stage_times.items():
+        stages[stage] = {
+            "count": len(times),
+            "p50": round(percentile(times, 50) * 1000, 2),
+            "p90": round(percentile(times, 90) * 1000, 2),
+            "p99": round(percentile(times, 99) * 1000, 2),
+        }
+    return {
+        "scenario": scenario,
+        "rounds_per_sec": round(scenario['rounds'] / wall_seconds, 3),
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_ms_per_round": round(cpu_seconds * 1000 / scenario['rounds'], 3),
+        "peak_memory_kb": round(peak_memory / 1024, 1),
+        "messages": len(state_tracker),
+        "stages": stages,
+        "prompt_tokens": {
+            "first": prompt_tokens[0] if prompt_tokens else 0,
+            "last": prompt_tokens[-1] if prompt_tokens else 0,
+            "max": max(prompt_tokens, default=0),
+            "growth_per_call": round((prompt_tokens[-1] - prompt_tokens[0]) / (len(prompt_tokens) - 1), 2)
+                               if len(prompt_tokens) > 1 else 0.0,
+        },
+        "cached_prompt_ratio": round(cached_total / prompt_total, 3) if prompt_total else 0.0,
+        "retries": llm_api.SCHEDULER.stats["retries"] - scheduler_before["retries"],
+        "failed_requests": llm_api.SCHEDULER.stats["failures"] - scheduler_before["failures"],
+    }
+
+def _prompt_token_totals():
+    """(prompt tokens, cached prompt tokens) recorded by llm_api.TELEMETRY so far."""
+    series = llm_api.TELEMETRY.series.values()
+    return sum(s["prompt_tokens"] for s in series), sum(s["cached_tokens"] for s in series)
+
+def _metric(result, path):
+    value = result
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+def failed_scenarios(results):
+    """Scenarios with failed requests: their timings measure error paths, not debates."""
+    return [name for name, result in results.items() if result['failed_requests']]
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns [(scenario, metric, baseline value, current value, relative change, regressed)].
+
+    Scenarios with failed requests, in this run or in the baseline, are not compared.
+    """
+    rows = []
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None or result['failed_requests'] or previous.get('failed_requests'):
+            continue
+        for path, higher_is_better in COMPARED_METRICS:
+            current, before = _metric(result, path), _metric(previous, path)
+            if current is None or not before:
+                continue
+            change = (current - before) / before
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            rows.append((name, ".".join(path), before, current, change, regressed))
+    return rows
+
+def print_results(results):
+    print("\n--- Benchmark Results ---")
+    print(f"{'scenario':<28}{'rounds/s':>10}{'cpu ms/rnd':>12}{'peak KB':>10}{'prompt tok':>16}{'cached':>8}{'retries':>9}"
+          f"{'failed':>8}")
+    for name, result in results.items():
+        prompt = result['prompt_tokens']
+        print(f"{name:<28}{result['rounds_per_sec']:>10.2f}{result['cpu_ms_per_round']:>12.2f}"
+              f"{result['peak_memory_kb']:>10.0f}{prompt['first']:>7} -> {prompt['max']:<6}"
+              f"{result['cached_prompt_ratio'] * 100:>7.0f}%{result['retries']:>9}{result['failed_requests']:>8}"
+              f"{'  INVALID' if result['failed_requests'] else ''}")
+        for stage, stats in result['stages'].items():
+            print(f"    {stage:<10} n={stats['count']:<4} p50 {stats['p50']:.1f} ms, "
+                  f"p90 {stats['p90']:.1f} ms, p99 {stats['p99']:.1f} ms")
+    print("-------------------------")
+
+def print_comparison(rows, tolerance):
+    print(f"\n--- Compared to baseline (tolerance {tolerance * 100:.0f}%) ---")
+    for name, metric, before, current, change, regressed in rows:
+        marker = "  REGRESSION" if regressed else ""
+        print(f"{name:<28}{metric:<24}{before:>12.2f} -> {current:<12.2f}{change * 100:+7.1f}%{marker}")
+    print("-------------------------")
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline load benchmark of the debate orchestration against a mock provider.')
+    parser.add_argument('--config', type=str, default=os.path.join(os.path.dirname(__file__), 'config', 'benchmark.yaml'),
+                        help='Benchmark configuration (mock provider settings and sweeps).')
+    parser.add_argument('--baseline', type=str, default=os.path.join('.cache', 'benchmark_baseline.json'),
+                        help='Baseline results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Relative change counted as a regression.')
+    parser.add_argument('--only', type=str, nargs='*', help='Run only the named scenarios (e.g. base agents=8).')
+    parser.add_argument('--output', type=str, default=None, help='Also write the results as JSON to this file.')
+    args = parser.parse_args()
+
+    config = load_benchmark_config(args.config)
+    mock_settings = config.get('mock') or {}
+    models_config = {
+        'models': {
+            BENCHMARK_MODEL_KEY: {
+                'api': "mock",
+                'name': "mock-model",
+                'context_window': (config.get('model') or {}).get('context_window', llm_api.DEFAULT_CONTEXT_WINDOW),
+                'tokenizer': "estimate",
+            },
+        },
+        'providers': {'mock': mock_settings},
+        'scheduler': config.get('scheduler'),
+    }
+    initialize_llm_api_map(models_config)
+
+    scenarios = expand_scenarios(config)
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario['name'] in args.only]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir:
+        for scenario in scenarios:
+            print(f"Running {scenario['name']} ({scenario['agents']} agents, {scenario['rounds']} rounds, "
+                  f"budget {scenario['history_budget']}, {scenario['response_length']})")
+            results[scenario['name']] = asyncio.run(run_scenario(scenario, mock_settings, log_dir))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = failed_scenarios(results)
+    if failed:
+        print(f"Invalid (failed requests, timings not comparable): {', '.join(failed)}")
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != config:
+            print(f"Note: {args.baseline} was recorded with a different benchmark config.")
+        rows = compare_to_baseline(results, baseline, args.tolerance)
+        print_comparison(rows, args.tolerance)
+        regressions = [row for row in rows if row[5]]
+
+    if args.save_baseline and failed:
+        print(f"Baseline not saved: {len(failed)} scenario(s) had failed requests.")
+    elif args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({"created": datetime.now().isoformat(timespec='seconds'), "config": config, "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed beyond {args.tolerance * 100:.0f}%.")
+    if regressions or failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
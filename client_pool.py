@@ -0,0 +1,121 @@
+# client_pool.py
+
+from collections import OrderedDict
+
+from utils import debug_print
+
+# Defaults for the shared HTTP connection pool; override per provider with
+# providers.<api>.http in models.yaml.
+DEFAULT_HTTP_SETTINGS = {
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 30.0,
+}
+
+# Per-call timeout in seconds; override per provider with providers.<api>.timeout
+DEFAULT_TIMEOUT = 60.0
+
+# Model handles kept; least recently used ones beyond this are dropped. Gemini
+# keys its handles by system instruction too, which differs per agent and topic.
+MAX_MODEL_HANDLES = 64
+
+class ClientPool:
+    """Keeps model handles and HTTP connection pools alive across calls.
+
+    Model handles are cached per (provider, model name), up to MAX_MODEL_HANDLES
+    in least-recently-used order. HTTP clients are shared
+    per provider and count how many requests opened a new connection versus
+    reusing a kept-alive one.
+    """
+
+    def __init__(self):
+        self.provider_settings = {}
+        self._handles = OrderedDict()
+        self._http_clients = {}
+        self.stats = {
+            "handles_created": 0,
+            "handles_reused": 0,
+            "handles_evicted": 0,
+            "requests": 0,
+            "connections_created": 0,
+        }
+
+    def configure(self, providers_config):
+        self.provider_settings = providers_config or {}
+
+    def timeout(self, api_type):
+        return float(self.provider_settings.get(api_type, {}).get("timeout", DEFAULT_TIMEOUT))
+
+    def http_settings(self, api_type):
+        settings = dict(DEFAULT_HTTP_SETTINGS)
+        settings.update(self.provider_settings.get(api_type, {}).get("http") or {})
+        return settings
+
+    def model_handle(self, api_type, model_name, factory):
+        key = (api_type, model_name)
+        handle = self._handles.get(key)
+        if handle is None:
+            handle = factory(model_name)
+            self._handles[key] = handle
+            self.stats["handles_created"] += 1
+            debug_print(f"ClientPool: created handle for {api_type}/{model_name}")
+            if len(self._handles) > MAX_MODEL_HANDLES:
+                self._handles.popitem(last=False)
+                self.stats["handles_evicted"] += 1
+        else:
+            self._handles.move_to_end(key)
+            self.stats["handles_reused"] += 1
+        return handle
+
+    def http_client(self, api_type, is_async=False):
+        """Returns a shared httpx client with keep-alive for the given provider."""
+        key = (api_type, is_async)
+        client = self._http_clients.get(key)
+        if client is not None:
+            return client
+
+        import httpx # Only needed by SDKs that accept an httpx client (openai)
+
+        settings = self.http_settings(api_type)
+        limits = httpx.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive_connections"],
+            keepalive_expiry=settings["keepalive_expiry"],
+        )
+        timeout = httpx.Timeout(self.timeout(api_type))
+
+        if is_async:
+            async def on_connection_event(event_name, info):
+                self._count_connection_event(event_name)
+
+            async def on_request(request):
+                self.stats["requests"] += 1
+                request.extensions["trace"] = on_connection_event
+
+            client = httpx.AsyncClient(limits=limits, timeout=timeout, event_hooks={"request": [on_request]})
+        else:
+            def on_connection_event(event_name, info):
+                self._count_connection_event(event_name)
+
+            def on_request(request):
+                self.stats["requests"] += 1
+                request.extensions["trace"] = on_connection_event
+
+            client = httpx.Client(limits=limits, timeout=timeout, event_hooks={"request": [on_request]})
+
+        self._http_clients[key] = client
+        return client
+
+    def _count_connection_event(self, event_name):
+        # httpcore only emits connect_tcp when a fresh connection is opened
+        if event_name == "connection.connect_tcp.complete":
+            self.stats["connections_created"] += 1
+
+    def print_report(self):
+        reused = max(self.stats["requests"] - self.stats["connections_created"], 0)
+        print("\n--- Client Pool ---")
+        print(f"Model handles: {self.stats['handles_created']} created, {self.stats['handles_reused']} reused, "
+              f"{self.stats['handles_evicted']} evicted")
+        print(f"HTTP connections: {self.stats['connections_created']} created, {reused} reused "
+              f"({self.stats['requests']} requests)")
+        print("-------------------")
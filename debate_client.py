@@ -0,0 +1,108 @@
+# debate_client.py
+#
+# Thin client for the debate daemon (`python main.py --serve`). It only needs the
+# standard library and PyYAML, so submitting a debate skips the SDK imports and
+# client setup that `main.py --topic` pays on every run.
+
+import argparse
+import json
+import socket
+import sys
+
+import yaml
+
+from utils import COLOR_RESET, COLOR_MODERATOR, COLOR_AGENT_A, COLOR_AGENT_B, COLOR_AGENT_C
+
+DEFAULT_LISTEN = "127.0.0.1:8765" # Keep in sync with debate_daemon.DEFAULT_LISTEN
+AGENT_COLORS = {"AI-A": COLOR_AGENT_A, "AI-B": COLOR_AGENT_B, "AI-C": COLOR_AGENT_C}
+
+def connect(address, socket_path=None, timeout=None):
+    if socket_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        return sock
+    host, _, port = address.rpartition(':')
+    return socket.create_connection((host or "127.0.0.1", int(port)), timeout=timeout)
+
+def request_events(sock, request):
+    """Sends one request and yields the daemon's events until it closes the connection."""
+    sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+    with sock.makefile('rb') as stream:
+        for line in stream:
+            yield json.loads(line)
+
+def load_agents(path):
+    """Agent overrides from a YAML file: an `agents:` list (as in agents.yaml) or a bare list."""
+    with open(path, 'r', encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    return config.get('agents') if isinstance(config, dict) else config
+
+def print_event(event):
+    kind = event['event']
+    if kind == 'queued':
+        position = f" (position {event['position']})" if event['position'] else ""
+        print(f"Queued as job {event['job']}{position}")
+    elif kind == 'started':
+        print(f"Job {event['job']} started: {event['topic']} ({event['mode']})")
+    elif kind == 'turn':
+        color = COLOR_MODERATOR if event['role'] == 'moderator' else AGENT_COLORS.get(event['speaker'], COLOR_RESET)
+        print(f"{color}[Round {event['round']}] {event['speaker']}:{COLOR_RESET}\n> {event['text']}")
+    elif kind == 'finished':
+        print(f"Job {event['job']} finished: {event['turns']} messages in {event['elapsed']:.1f}s, log saved to {event['log']}")
+    elif kind == 'failed':
+        print(f"Job {event['job']} failed: {event['error']}")
+    elif kind == 'rejected':
+        print(f"Rejected: {event['error']}")
+    elif kind == 'status':
+        print(f"Running: {event['running']}/{event['workers']}, queued: {event['queued']}/{event['max_queue']}")
+        print(f"Completed: {event['completed']}, failed: {event['failed']}, rejected: {event['rejected']}")
+        print(f"Uptime: {event['uptime']:.0f}s, models: {', '.join(event['models'])}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Submit a debate to a running debate daemon and stream its turns.')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('--topic', type=str, help='The topic of the discussion.')
+    action.add_argument('--status', action='store_true', help='Show the daemon\'s running and queued jobs.')
+    parser.add_argument('--rounds', type=int, default=None, help='Number of discussion rounds (default: the daemon\'s).')
+    parser.add_argument('--mode', choices=['debate', 'conversation', 'panel'], default=None,
+                        help='Discussion mode (default: the daemon\'s).')
+    parser.add_argument('--summarize-rounds', action='store_true', default=None, help='Moderator summarizes each round.')
+    parser.add_argument('--agents', type=str, default=None, help='YAML file of agents replacing the default ones.')
+    parser.add_argument('--connect', type=str, default=DEFAULT_LISTEN, help='HOST:PORT of the daemon.')
+    parser.add_argument('--socket', type=str, default=None, help='Unix socket of the daemon (instead of --connect).')
+    parser.add_argument('--json', action='store_true', help='Print the raw JSON events.')
+    args = parser.parse_args()
+
+    if args.status:
+        request = {'type': 'status'}
+    else:
+        request = {'type': 'debate', 'topic': args.topic}
+        for key in ('rounds', 'mode', 'summarize_rounds'):
+            if getattr(args, key) is not None:
+                request[key] = getattr(args, key)
+        if args.agents:
+            request['agents'] = load_agents(args.agents)
+
+    try:
+        sock = connect(args.connect, args.socket)
+    except OSError as e:
+        print(f"Could not connect to the debate daemon at {args.socket or args.connect}: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    exit_code = 1 # The daemon closed the connection without a final event
+    with sock:
+        for event in request_events(sock, request):
+            if args.json:
+                print(json.dumps(event, ensure_ascii=False), flush=True)
+            else:
+                print_event(event)
+                sys.stdout.flush()
+            if event['event'] in ('finished', 'status'):
+                exit_code = 0
+            elif event['event'] == 'rejected':
+                exit_code = 2
+    sys.exit(exit_code)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+# debate_daemon.py
+
+import asyncio
+import json
+import os
+import time
+
+import llm_api
+from moderator_engine import ModeratorEngine
+from agent_engine import AgentEngine
+from state_tracker import StateTracker
+from debate_runner import run_debate
+from telemetry import call_context
+from utils import debug_print
+
+DEFAULT_LISTEN = "127.0.0.1:8765"
+DEBATE_MODES = ("debate", "conversation", "panel")
+
+# Request and event lines are JSON; a request with inline agent overrides is still far below this
+MAX_REQUEST_BYTES = 1024 * 1024
+
+class DebateDaemon:
+    """Runs debate jobs submitted over a local socket, reusing one warm set of clients.
+
+    Protocol: the client sends one JSON line and gets JSON lines back.
+
+      {"type": "debate", "topic": ..., "rounds": 5, "mode": "debate" | "conversation" | "panel",
+       "summarize_rounds": false, "agents": [...]}   (rounds, mode, summarize_rounds, agents optional)
+        -> {"event": "queued", "job": id, "position": n}
+           {"event": "started", "job": id, "topic": ...}
+           {"event": "turn", "job": id, "round": ..., "speaker": ..., "role": ..., "text": ..., "metadata": ...}
+           ...
+           {"event": "finished", "job": id, "log": path, "turns": n, "elapsed": seconds}
+           or {"event": "failed", "job": id, "error": ...}
+        or {"event": "rejected", "error": ...} if the request is invalid or the queue is full
+
+      {"type": "status"} -> {"event": "status", "running": ..., "queued": ..., ...}
+
+    `agents` replaces the default agents (same format as agents.yaml). At most
+    `workers` debates run at once; up to `max_queue` more wait, and further
+    submissions are rejected instead of piling up. A job keeps running if its
+    client disconnects; its log is saved either way.
+    """
+
+    def __init__(self, agents_config, workers=4, max_queue=16, default_rounds=5, summarize_rounds=False,
+                 default_mode="debate", log_dir='logs'):
+        self.agents_config = agents_config
+        self.moderator_config = agents_config['moderator']
+        self.workers = max(1, workers)
+        # Unbounded: max_queue is enforced in submit(), where jobs an idle worker is about to take are not counted
+        self.queue = asyncio.Queue()
+        self.max_queue = max_queue
+        self.idle_workers = 0
+        self.default_rounds = default_rounds
+        self.summarize_rounds = summarize_rounds
+        self.default_mode = default_mode
+        self.log_dir = log_dir
+        # Engines hold no per-debate state, so the ones for the default agents are built once
+        self.engines = {
+            conversation_mode: (ModeratorEngine(self.moderator_config, conversation_mode),
+                                AgentEngine(agents_config['agents'], conversation_mode))
+            for conversation_mode in (False, True)
+        }
+        self.next_job_id = 1
+        self.stats = {'running': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+        self.started_at = time.perf_counter()
+
+    def parse_job(self, request):
+        """Validates a debate request and returns a job dict. Raises ValueError."""
+        topic = request.get('topic')
+        if not isinstance(topic, str) or not topic.strip():
+            raise ValueError("'topic' is required.")
+        rounds = request.get('rounds', self.default_rounds)
+        # bool is a subclass of int, so `"rounds": true` would otherwise pass as 1
+        if not isinstance(rounds, int) or isinstance(rounds, bool) or rounds < 1:
+            raise ValueError("'rounds' must be a positive integer.")
+        summarize_rounds = request.get('summarize_rounds', self.summarize_rounds)
+        if not isinstance(summarize_rounds, bool):
+            raise ValueError("'summarize_rounds' must be true or false.")
+        mode = request.get('mode') or self.default_mode
+        if mode not in DEBATE_MODES:
+            raise ValueError(f"Unknown mode '{mode}'. Available: {', '.join(DEBATE_MODES)}")
+        agents = request.get('agents')
+        if agents is not None:
+            if not isinstance(agents, list) or not agents:
+                raise ValueError("'agents' must be a non-empty list.")
+            for agent in agents:
+                missing = [key for key in ('name', 'model', 'persona') if not isinstance(agent, dict) or key not in agent]
+                if missing:
+                    raise ValueError(f"Agent entry {agent!r} is missing {', '.join(missing)}.")
+                if agent['model'] not in llm_api.LLM_API_MAP:
+                    raise ValueError(f"Agent {agent['name']} uses unknown model '{agent['model']}'.")
+        return {
+            'topic': topic,
+            'rounds': rounds,
+            'mode': mode,
+            'summarize_rounds': summarize_rounds,
+            'agents': agents,
+        }
+
+    def waiting(self):
+        """Queued jobs that no idle worker will pick up."""
+        return max(0, self.queue.qsize() - self.idle_workers)
+
+    def submit(self, job, send):
+        """Queues a job whose events are passed to `send`. Raises asyncio.QueueFull.
+
+        Returns the job's position among the waiting jobs, 0 if a worker takes it right away.
+        """
+        if self.max_queue and self.waiting() >= self.max_queue:
+            raise asyncio.QueueFull()
+        job['id'] = self.next_job_id
+        job['send'] = send
+        self.queue.put_nowait(job)
+        self.next_job_id += 1
+        return self.waiting()
+
+    def status(self):
+        return {
+            'event': 'status',
+            'running': self.stats['running'],
+            'queued': self.waiting(),
+            'max_queue': self.max_queue,
+            'workers': self.workers,
+            'completed': self.stats['completed'],
+            'failed': self.stats['failed'],
+            'rejected': self.stats['rejected'],
+            'uptime': round(time.perf_counter() - self.started_at, 1),
+            'models': sorted(llm_api.LLM_API_MAP),
+        }
+
+    async def _run_job(self, job):
+        conversation_mode = job['mode'] == 'conversation'
+        if job['agents'] is None:
+            moderator_engine, agent_engine = self.engines[conversation_mode]
+            agent_configs = self.agents_config['agents']
+        else:
+            agent_configs = job['agents']
+            moderator_engine = ModeratorEngine(self.moderator_config, conversation_mode)
+            agent_engine = AgentEngine(agent_configs, conversation_mode)
+
+        moderator_name = self.moderator_config['name']
+
+        def on_message(message):
+            job['send']({
+                'event': 'turn', 'job': job['id'], 'round': message.round, 'speaker': message.speaker,
+                'role': 'moderator' if message.speaker == moderator_name else 'agent',
+                'text': message.text, 'metadata': message.metadata,
+            })
+
+        state_tracker = StateTracker(log_dir=self.log_dir, token_counters=llm_api.model_token_counters(),
+                                     on_message=on_message)
+        log_path = state_tracker.start_log(job['topic'], suffix=f"d{job['id']:04d}")
+        started_at = time.perf_counter()
+        try:
+            with call_context(debate=job['id']):
+                await run_debate(
+                    job['topic'], job['rounds'], moderator_engine, agent_engine, state_tracker,
+                    self.moderator_config, agent_configs, summarize_rounds=job['summarize_rounds'], echo=False,
+                    panel=job['mode'] == 'panel'
+                )
+        finally:
+            state_tracker.save_logs(job['topic'])
+        return {'log': log_path, 'turns': len(state_tracker), 'elapsed': round(time.perf_counter() - started_at, 3)}
+
+    async def worker(self, worker_id):
+        while True:
+            self.idle_workers += 1
+            try:
+                job = await self.queue.get()
+            finally:
+                self.idle_workers -= 1
+            debug_print(f"[daemon worker {worker_id}] starting job {job['id']}: {job['topic']}")
+            self.stats['running'] += 1
+            job['send']({'event': 'started', 'job': job['id'], 'topic': job['topic'], 'mode': job['mode']})
+            try:
+                result = await self._run_job(job)
+                self.stats['completed'] += 1
+                job['send'](dict({'event': 'finished', 'job': job['id']}, **result))
+                print(f"[job {job['id']}] Finished: {job['topic']} ({result['elapsed']:.1f}s)")
+            except Exception as e:
+                self.stats['failed'] += 1
+                job['send']({'event': 'failed', 'job': job['id'], 'error': f"{type(e).__name__}: {e}"})
+                print(f"[job {job['id']}] Failed: {job['topic']} ({type(e).__name__}: {e})")
+            finally:
+                self.stats['running'] -= 1
+                self.queue.task_done()
+                self._write_metrics()
+
+    def _write_metrics(self):
+        # The daemon runs until it is stopped, so the Prometheus textfile is refreshed per job
+        # instead of only at shutdown (TELEMETRY.close)
+        try:
+            llm_api.TELEMETRY.write_prometheus()
+        except OSError as e:
+            print(f"Could not write the Prometheus file: {e}")
+
+    async def handle_connection(self, reader, writer):
+        events = asyncio.Queue()
+        job = None
+        try:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                # readline() raises ValueError (not LimitOverrunError) for a line over the stream limit
+                await _send(writer, {'event': 'rejected', 'error': f"Request exceeds {MAX_REQUEST_BYTES} bytes."})
+                # Closing with the rest of the request unread would reset the connection before
+                # the client reads the rejection, so signal the end and discard input until it hangs up
+                writer.write_eof()
+                await _until_disconnected(reader)
+                return
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("Request must be a JSON object.")
+            except ValueError as e:
+                await _send(writer, {'event': 'rejected', 'error': f"Invalid request: {e}"})
+                return
+
+            request_type = request.get('type', 'debate')
+            if request_type == 'status':
+                await _send(writer, self.status())
+                return
+            if request_type != 'debate':
+                await _send(writer, {'event': 'rejected', 'error': f"Unknown request type '{request_type}'."})
+                return
+
+            try:
+                job = self.parse_job(request)
+                position = self.submit(job, events.put_nowait)
+            except ValueError as e:
+                self.stats['rejected'] += 1
+                await _send(writer, {'event': 'rejected', 'error': str(e)})
+                return
+            except asyncio.QueueFull:
+                self.stats['rejected'] += 1
+                await _send(writer, {'event': 'rejected', 'error': f"Queue full ({self.max_queue} jobs waiting), try again later."})
+                return
+
+            await _send(writer, {'event': 'queued', 'job': job['id'], 'position': position})
+            # The client sends nothing after its request, so the end of its stream means it has gone
+            client_gone = asyncio.ensure_future(_until_disconnected(reader))
+            try:
+                while True:
+                    next_event = asyncio.ensure_future(events.get())
+                    await asyncio.wait({next_event, client_gone}, return_when=asyncio.FIRST_COMPLETED)
+                    if client_gone.done():
+                        next_event.cancel()
+                        debug_print(f"[daemon] client of job {job['id']} disconnected")
+                        return
+                    event = next_event.result()
+                    await _send(writer, event)
+                    if event['event'] in ('finished', 'failed'):
+                        return
+            finally:
+                client_gone.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            # The job (if any) keeps running, but nobody reads its events any more
+            debug_print(f"[daemon] client disconnected: {e}")
+        finally:
+            if job is not None:
+                job['send'] = _discard
+            writer.close()
+
+    async def serve(self, listen=DEFAULT_LISTEN, socket_path=None):
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.unlink(socket_path) # Stale socket from a previous run
+            server = await asyncio.start_unix_server(self.handle_connection, path=socket_path, limit=MAX_REQUEST_BYTES)
+            address = socket_path
+        else:
+            host, port = parse_address(listen)
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_REQUEST_BYTES)
+            address = f"{host}:{port}"
+
+        workers = [asyncio.create_task(self.worker(i)) for i in range(self.workers)]
+        print(f"Debate daemon listening on {address} ({self.workers} workers, queue of {self.max_queue})")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in workers:
+                task.cancel()
+            if socket_path and os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+def _discard(event):
+    pass
+
+async def _until_disconnected(reader):
+    try:
+        await reader.read()
+    except ConnectionError:
+        pass
+
+async def _send(writer, event):
+    writer.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+    await writer.drain()
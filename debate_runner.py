@@ -0,0 +1,243 @@
+# debate_runner.py
+
+import asyncio
+import builtins
+import time
+
+import llm_api
+from request_scheduler import LLMRequestError
+from utils import COLOR_RESET, COLOR_MODERATOR, COLOR_AGENT_A, COLOR_AGENT_B, COLOR_AGENT_C
+
+class TurnTimer:
+    """Chunk callback that records time-to-first-token and total generation time.
+
+    Chunks are passed on to `emit`; with emit=None they are only timed.
+    """
+
+    def __init__(self, emit=None):
+        self.emit = emit
+        self.started_at = time.perf_counter()
+        self.first_chunk_at = None
+
+    def __call__(self, chunk):
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        if self.emit is not None:
+            self.emit(chunk)
+
+    def metrics(self):
+        finished_at = time.perf_counter()
+        first_chunk_at = self.first_chunk_at or finished_at
+        return {
+            "ttft": round(first_chunk_at - self.started_at, 3),
+            "generation_time": round(finished_at - self.started_at, 3),
+        }
+
+def color_for_agent(agent_name):
+    # Determine agent color
+    agent_color = COLOR_RESET
+    if agent_name == "AI-A":
+        agent_color = COLOR_AGENT_A
+    elif agent_name == "AI-B":
+        agent_color = COLOR_AGENT_B
+    elif agent_name == "AI-C":
+        agent_color = COLOR_AGENT_C
+    return agent_color
+
+async def run_debate(topic, rounds, moderator_engine, agent_engine, state_tracker,
+                     moderator_config, agent_configs, summarize_rounds=False, echo=True, stream=False,
+                     speculator=None, panel=False):
+    # Batch runs interleave many debates, so terminal output can be turned off.
+    print = builtins.print if echo else (lambda *args, **kwargs: None)
+
+    def emit_chunk(chunk):
+        print(chunk, end="", flush=True)
+
+    first_round, resumed_speaker = resume_point(state_tracker, moderator_engine, moderator_config, agent_configs)
+    if not len(state_tracker):
+        # Initial moderator statement
+        initial_moderator_statement = f"本日は「{topic}」について議論します。"
+        state_tracker.add_message(0, moderator_config['name'], initial_moderator_statement)
+        print(f"{COLOR_MODERATOR}[Round 0] {moderator_config['name']}:{COLOR_RESET}\n> {initial_moderator_statement}")
+    else:
+        print(f"Resuming at round {first_round} ({len(state_tracker)} logged messages)")
+
+    pending_summary = None
+    for round_num in range(first_round, rounds + 1):
+        with llm_api.TELEMETRY.track_round(round_num):
+            if panel:
+                await _panel_round(
+                    topic, round_num, moderator_engine, agent_engine, state_tracker, moderator_config, agent_configs,
+                    pending_summary, print, question_logged=resumed_speaker is not None
+                )
+                resumed_speaker = pending_summary = None
+                if summarize_rounds and round_num < rounds:
+                    pending_summary = asyncio.create_task(moderator_engine.aupdate_summary(topic, state_tracker))
+                continue
+
+            speculative_tasks = None
+            if resumed_speaker is not None:
+                # The moderator turn of this round was already logged before the interruption
+                next_speaker_name, resumed_speaker = resumed_speaker, None
+                print(f"\n{COLOR_RESET}[Round {round_num}]{COLOR_RESET}")
+            else:
+                if speculator is not None and moderator_engine.uses_llm(round_num):
+                    # Start likely agent responses alongside the moderator call
+                    speculative_tasks = speculator.start(topic, state_tracker, agent_configs)
+                next_speaker_name = await _moderator_turn(
+                    topic, round_num, moderator_engine, state_tracker, moderator_config, agent_configs,
+                    pending_summary, stream, print
+                )
+                pending_summary = None
+
+            agent_color = color_for_agent(next_speaker_name)
+
+            # Agent responds. If its model fails even after retries and failover the
+            # turn is skipped, so no error text ends up in the history.
+            try:
+                speculative_response = None
+                if speculative_tasks is not None:
+                    speculative_response = await speculator.resolve(speculative_tasks, next_speaker_name)
+
+                if speculative_response is not None:
+                    state_tracker.add_message(round_num, next_speaker_name, speculative_response, {"speculative": True})
+                    print(f"{agent_color}[{next_speaker_name}]:{COLOR_RESET}\n> {speculative_response}")
+                elif stream:
+                    print(f"{agent_color}[{next_speaker_name}]:{COLOR_RESET}\n> ", end="")
+                    agent_timer = TurnTimer(emit_chunk)
+                    agent_response = await agent_engine.aget_agent_response(
+                        next_speaker_name, topic, agent_engine.recent_history(next_speaker_name, state_tracker),
+                        on_chunk=agent_timer
+                    )
+                    print()
+                    state_tracker.add_message(round_num, next_speaker_name, agent_response,
+                                              dict(model=agent_engine.agents[next_speaker_name]['model_key'], **agent_timer.metrics()))
+                else:
+                    agent_response = await agent_engine.aget_agent_response(
+                        next_speaker_name, topic, agent_engine.recent_history(next_speaker_name, state_tracker)
+                    )
+                    state_tracker.add_message(round_num, next_speaker_name, agent_response)
+                    print(f"{agent_color}[{next_speaker_name}]:{COLOR_RESET}\n> {agent_response}")
+            except LLMRequestError as e:
+                print(f"\n{agent_color}[{next_speaker_name}]:{COLOR_RESET} (no response, turn skipped: {e})")
+
+            if summarize_rounds and round_num < rounds: # Summarize if not the last round
+                # Only the messages added since the previous summary are sent
+                pending_summary = asyncio.create_task(moderator_engine.aupdate_summary(topic, state_tracker))
+
+async def _moderator_turn(topic, round_num, moderator_engine, state_tracker, moderator_config, agent_configs,
+                          pending_summary, stream, print):
+    if not moderator_engine.uses_llm(round_num):
+        # Local speaker policy: no LLM call, templated statement
+        if pending_summary is not None:
+            summary = await pending_summary
+            print(f"{COLOR_MODERATOR}[Moderator Summary]:{COLOR_RESET}\n> {summary}")
+        print(f"\n{COLOR_RESET}[Round {round_num}]{COLOR_RESET}")
+        next_speaker_name, moderator_statement = moderator_engine.local_decision(
+            moderator_engine.recent_history(state_tracker), round_num, agent_configs
+        )
+        print(f"{COLOR_MODERATOR}[{moderator_config['name']}]:{COLOR_RESET}\n> {moderator_statement}")
+        state_tracker.add_message(round_num, moderator_config['name'], moderator_statement,
+                                  {"next_speaker": next_speaker_name, "policy": moderator_engine.speaker_policy.name})
+        return next_speaker_name
+
+    # Moderator decides next speaker. The previous round's summary (if any)
+    # is generated concurrently with this decision.
+    # The raw response carries <呼びかけ>/<簡単な説明> tags, so it is timed but not echoed;
+    # the parsed statement (or the templated fallback) is printed once the decision is made
+    moderator_timer = TurnTimer() if stream else None
+    decision_task = asyncio.create_task(moderator_engine.adecide_next_speaker(
+        topic, moderator_engine.recent_history(state_tracker), round_num, agent_configs,
+        on_chunk=moderator_timer
+    ))
+    if pending_summary is not None:
+        summary = await pending_summary
+        print(f"{COLOR_MODERATOR}[Moderator Summary]:{COLOR_RESET}\n> {summary}")
+
+    print(f"\n{COLOR_RESET}[Round {round_num}]{COLOR_RESET}")
+
+    next_speaker_name, moderator_statement = await decision_task
+    # next_speaker is logged so an interrupted round can be resumed without re-asking the moderator
+    metadata = {"next_speaker": next_speaker_name}
+    if stream:
+        metadata.update(model=moderator_engine.model_key, **moderator_timer.metrics())
+    print(f"{COLOR_MODERATOR}[{moderator_config['name']}]:{COLOR_RESET}\n> {moderator_statement}")
+    state_tracker.add_message(round_num, moderator_config['name'], moderator_statement, metadata)
+    return next_speaker_name
+
+async def _panel_round(topic, round_num, moderator_engine, agent_engine, state_tracker, moderator_config,
+                       agent_configs, pending_summary, print, question_logged=False):
+    """One panel round: the moderator asks one question and every agent answers it concurrently.
+
+    All agents see the same history snapshot. Answers are printed as they
+    complete and appended to the StateTracker in agents.yaml order.
+    """
+    if not question_logged:
+        question_task = asyncio.create_task(moderator_engine.apose_panel_question(
+            topic, moderator_engine.recent_history(state_tracker), round_num, agent_configs
+        ))
+    if pending_summary is not None:
+        summary = await pending_summary
+        print(f"{COLOR_MODERATOR}[Moderator Summary]:{COLOR_RESET}\n> {summary}")
+
+    print(f"\n{COLOR_RESET}[Round {round_num}] (panel){COLOR_RESET}")
+    if not question_logged:
+        question = await question_task
+        state_tracker.add_message(round_num, moderator_config['name'], question, {"panel": True})
+        print(f"{COLOR_MODERATOR}[{moderator_config['name']}]:{COLOR_RESET}\n> {question}")
+
+    agent_names = [agent['name'] for agent in agent_configs]
+    snapshots = {name: agent_engine.recent_history(name, state_tracker) for name in agent_names}
+
+    async def answer(agent_name):
+        try:
+            return agent_name, await agent_engine.aget_agent_response(agent_name, topic, snapshots[agent_name])
+        except LLMRequestError as e:
+            return agent_name, e
+
+    responses = {}
+    for next_answer in asyncio.as_completed([answer(name) for name in agent_names]):
+        agent_name, response = await next_answer
+        if isinstance(response, LLMRequestError):
+            print(f"{color_for_agent(agent_name)}[{agent_name}]:{COLOR_RESET} (no response: {response})")
+            continue
+        responses[agent_name] = response
+        print(f"{color_for_agent(agent_name)}[{agent_name}]:{COLOR_RESET}\n> {response}")
+
+    for agent_name in agent_names:
+        if agent_name in responses:
+            state_tracker.add_message(round_num, agent_name, responses[agent_name])
+
+def resume_point(state_tracker, moderator_engine, moderator_config, agent_configs):
+    """Returns (first round to run, speaker already chosen for that round or None).
+
+    For a fresh StateTracker this is (1, None). After resuming a log, a round
+    whose moderator turn was logged but whose agent turn was not is continued
+    with the logged choice of speaker.
+    """
+    if not len(state_tracker):
+        return 1, None
+    history = state_tracker.get_history()
+    last_message = history[-1]
+    if last_message['speaker'] == moderator_config['name'] and last_message['round'] > 0:
+        speaker = (last_message.metadata or {}).get('next_speaker')
+        if speaker is None:
+            speaker = moderator_engine.speaker_for_statement(last_message['text'], history, agent_configs)
+        return last_message['round'], speaker
+    return last_message['round'] + 1, None
+
+def print_timing_report(state_tracker):
+    """Prints average time-to-first-token and generation time per model for streamed turns."""
+    timings = {}
+    for message in state_tracker.get_history():
+        metadata = message.metadata or {}
+        if "ttft" in metadata:
+            timings.setdefault(metadata.get("model", "?"), []).append(metadata)
+    if not timings:
+        return
+    print("\n--- Streaming Timings ---")
+    for model_key, entries in timings.items():
+        average_ttft = sum(entry["ttft"] for entry in entries) / len(entries)
+        average_total = sum(entry["generation_time"] for entry in entries) / len(entries)
+        print(f"{model_key}: {len(entries)} turns, avg TTFT {average_ttft:.2f}s, avg total {average_total:.2f}s")
+    print("-------------------------")
@@ -1,10 +1,24 @@
 # llm_api.py
 
+import asyncio
+import collections
+import contextlib
 import random
 import os
-from openai import OpenAI
-import google.generativeai as genai
+import re
+import time
 from utils import debug_print # Import debug_print from utils.py
+from response_cache import CachedClient
+from client_pool import ClientPool
+from request_scheduler import RequestScheduler, ScheduledClient
+from token_counter import get_token_counter, DEFAULT_TOKEN_COUNTER
+from telemetry import Telemetry, MeteredClient, report_usage
+
+# Provider SDKs are imported lazily by each client's load_sdk(), so a run only
+# pays for the SDKs of providers that models.yaml actually uses.
+OpenAI = None
+AsyncOpenAI = None
+genai = None
 
 debug_print("Loading llm_api.py (real OpenAI and Gemini APIs)")
 
@@ -30,44 +44,167 @@ RESPONSE_LENGTH_SETTINGS = {
     },
 }
 
+# Default number of in-flight async requests per provider.
+# Can be overridden with the optional `providers:` section of models.yaml.
+PROVIDER_CONCURRENCY = {
+    "openai": 8,
+    "gemini": 4,
+    "deepseek": 32,
+    "mock": 32,
+}
+
+# Cap on in-flight async requests across all providers (None = unlimited).
+GLOBAL_CONCURRENCY = None
+
+# Concurrency semaphores of the event loop in use. An asyncio.Semaphore belongs to
+# the loop it was first waited on, so they are rebuilt whenever a new loop starts
+# using them (e.g. one asyncio.run() per benchmark scenario).
+_SEMAPHORES = {"loop": None, "global": None, "providers": {}}
+
+# Number of async requests issued per provider, used for throughput reports.
+PROVIDER_CALL_COUNTS = {}
+
+def _loop_semaphores():
+    loop = asyncio.get_running_loop()
+    if _SEMAPHORES["loop"] is not loop:
+        _SEMAPHORES["loop"] = loop
+        _SEMAPHORES["global"] = asyncio.Semaphore(GLOBAL_CONCURRENCY) if GLOBAL_CONCURRENCY is not None else None
+        _SEMAPHORES["providers"] = {}
+    return _SEMAPHORES
+
+def provider_semaphore(api_type):
+    """Returns the asyncio.Semaphore that caps concurrent calls to a provider on the running loop."""
+    providers = _loop_semaphores()["providers"]
+    semaphore = providers.get(api_type)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(PROVIDER_CONCURRENCY.get(api_type, 4))
+        providers[api_type] = semaphore
+    return semaphore
+
+def set_global_concurrency(limit):
+    global GLOBAL_CONCURRENCY
+    GLOBAL_CONCURRENCY = limit
+    _SEMAPHORES["loop"] = None # Rebuilt with the new limits on next use
+
+@contextlib.asynccontextmanager
+async def request_slot(api_type):
+    """Holds a per-provider and a global slot for the duration of one API call.
+
+    The provider slot is taken first, so a call queued behind a saturated
+    provider does not hold a global slot that calls to idle providers could use.
+    """
+    global_semaphore = _loop_semaphores()["global"]
+    async with contextlib.AsyncExitStack() as stack:
+        await stack.enter_async_context(provider_semaphore(api_type))
+        if global_semaphore is not None:
+            await stack.enter_async_context(global_semaphore)
+        PROVIDER_CALL_COUNTS[api_type] = PROVIDER_CALL_COUNTS.get(api_type, 0) + 1
+        yield
+
+# Shared model handles and HTTP connection pools for all clients
+CLIENT_POOL = ClientPool()
+
+# Rate limits, retries, hedging and failover for every model in LLM_API_MAP
+SCHEDULER = RequestScheduler()
+
+# Per-call latency, token and cost records for every model in LLM_API_MAP
+TELEMETRY = Telemetry()
+
 # --- OpenAI API Implementation ---
 class OpenAIAPI:
+    api_type = "openai"
+
+    @staticmethod
+    def load_sdk():
+        global OpenAI, AsyncOpenAI
+        from openai import OpenAI, AsyncOpenAI
+
     def __init__(self):
         debug_print("OpenAIAPI __init__ called")
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable not set.")
-        self.client = OpenAI(api_key=api_key)
+        self.client = OpenAI(api_key=api_key, max_retries=0, http_client=CLIENT_POOL.http_client(self.api_type))
+        self.async_client = AsyncOpenAI(api_key=api_key, max_retries=0,
+                                        http_client=CLIENT_POOL.http_client(self.api_type, is_async=True))
 
-    def generate(self, prompt, model_name, response_length="medium"):
+    def _build_request(self, prompt, model_name, response_length):
         settings = RESPONSE_LENGTH_SETTINGS.get(response_length, RESPONSE_LENGTH_SETTINGS["medium"])
         instruction = settings["instruction"]
         max_tokens = settings["max_tokens"]
         temperature = settings.get("temperature", 0.7)  # fallback 値あり
         top_p = settings.get("top_p", 1.0)
 
-        full_prompt = f"{prompt}\n\n{instruction}"
+        chat_messages = getattr(prompt, 'messages', None)
+        if chat_messages is not None:
+            # ChatPrompt: the length instruction closes the system prefix, so everything
+            # up to the newest history message is identical across turns (prompt caching)
+            messages = [{"role": "system", "content": f"{prompt.system}\n\n{instruction}"}] + chat_messages
+        else:
+            messages = [{"role": "user", "content": f"{prompt}\n\n{instruction}"}]
+
+        debug_print(f"OpenAIAPI generate called with model '{model_name}', length '{response_length}' and prompt: {prompt[:100]}...")
+
+        return dict(
+            model=model_name,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            timeout=CLIENT_POOL.timeout(self.api_type)
+        )
 
-        debug_print(f"OpenAIAPI generate called with model '{model_name}', length '{response_length}' and prompt: {full_prompt[:100]}...")
+    # Errors propagate to the RequestScheduler, which retries or fails over.
+    # The SDK's own retries are disabled (max_retries=0) so they do not stack with it.
 
-        try:
-            chat_completion = self.client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "user", "content": full_prompt}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p
+    def _report_usage(self, model_name, usage):
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            report_usage(self.api_type, model_name, usage.prompt_tokens, usage.completion_tokens,
+                         getattr(details, "cached_tokens", 0))
+
+    def generate(self, prompt, model_name, response_length="medium"):
+        request = self._build_request(prompt, model_name, response_length)
+        chat_completion = self.client.chat.completions.create(**request)
+        self._report_usage(model_name, chat_completion.usage)
+        return chat_completion.choices[0].message.content
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        request = self._build_request(prompt, model_name, response_length)
+        async with request_slot(self.api_type):
+            chat_completion = await self.async_client.chat.completions.create(**request)
+        self._report_usage(model_name, chat_completion.usage)
+        return chat_completion.choices[0].message.content
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        """Yields the response text in chunks as they arrive."""
+        request = self._build_request(prompt, model_name, response_length)
+        # include_usage adds a final chunk with no choices that carries the token usage
+        for chunk in self.client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **request):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            self._report_usage(model_name, getattr(chunk, "usage", None))
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        request = self._build_request(prompt, model_name, response_length)
+        async with request_slot(self.api_type):
+            response_stream = await self.async_client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **request
             )
-            return chat_completion.choices[0].message.content
-        except Exception as e:
-            debug_print(f"Error calling OpenAI API: {e}")
-            return f"[OpenAI API Error]: {e}"
+            async for chunk in response_stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                self._report_usage(model_name, getattr(chunk, "usage", None))
 
 
 # --- Mock API Implementations (for DeepSeek) ---
 class DeepSeekAPI:
+    api_type = "deepseek"
+
+    @staticmethod
+    def load_sdk():
+        pass # Mock client, nothing to import
+
     def __init__(self):
         debug_print("DeepSeekAPI __init__ called (mock)")
 
@@ -77,7 +214,168 @@ class DeepSeekAPI:
         
         return f"[DeepSeek Mock Response]: {random.choice(['なるほど、それは考慮すべき点ですね。', '私の知る限りでは、そのデータは正確ではありません。', 'より詳細な分析が必要です。', 'その提案は現実的ではありません。'])} (Model: {model_name}, Length: {response_length}, Prompt: {prompt[:50]}...)"
 
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        async with request_slot(self.api_type):
+            return self.generate(prompt, model_name, response_length)
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        text = self.generate(prompt, model_name, response_length)
+        for start in range(0, len(text), 8):
+            yield text[start:start + 8]
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        async with request_slot(self.api_type):
+            for chunk in self.stream(prompt, model_name, response_length):
+                yield chunk
+                await asyncio.sleep(0)
+
+class MockAPIError(Exception):
+    """Failure injected by MockAPI; status_code and retry_after mimic the provider SDK errors."""
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"Mock API error {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+# Filler for MockAPI responses; with the estimate token counter each character is about one token
+MOCK_CHUNK_SIZE = 8 # Characters per MockAPI stream chunk
+MOCK_FILLER = "その点については様々な見方がありますが具体的な事例と根拠を踏まえて慎重に検討する必要があります。"
+
+def _common_prefix_length(a, b):
+    """Length of the common prefix of two strings (binary search over C-level slice compares)."""
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+class MockAPI:
+    """Offline provider with configurable latency, throughput, response size and failures.
+
+    Settings come from providers.mock in models.yaml (or configure()):
+      latency: {distribution: fixed|uniform|normal|lognormal, mean, stddev, min, max, median, sigma}
+               time to first token, in seconds
+      tokens_per_second: generation speed after the first token (0 = instant)
+      response_fill: [low, high] fraction of the response length's max_tokens to generate
+      error_rate / rate_limit_rate: probability of a 500 / 429 (with retry_after seconds)
+      prompt_cache: {min_tokens, block_tokens, entries} simulates provider prefix caching:
+               the longest prefix shared with one of the last `entries` prompts is
+               reported as cached tokens (in whole blocks, from min_tokens on)
+      seed: makes latencies, sizes and failures reproducible
+    """
+    api_type = "mock"
+
+    @staticmethod
+    def load_sdk():
+        pass # Nothing to import
+
+    def __init__(self):
+        debug_print("MockAPI __init__ called")
+        self.configure(CLIENT_POOL.provider_settings.get(self.api_type))
+
+    def configure(self, settings):
+        settings = settings or {}
+        self.latency = settings.get('latency') or {"distribution": "fixed", "mean": 0.0}
+        self.tokens_per_second = float(settings.get('tokens_per_second', 0))
+        self.response_fill = settings.get('response_fill', [1.0, 1.0])
+        self.error_rate = float(settings.get('error_rate', 0.0))
+        self.rate_limit_rate = float(settings.get('rate_limit_rate', 0.0))
+        self.retry_after = float(settings.get('retry_after', 1.0))
+        self.random = random.Random(settings.get('seed'))
+        self.prompt_cache = settings.get('prompt_cache')
+        self._recent_prompts = {}
+
+    def _first_token_latency(self):
+        latency = self.latency
+        distribution = latency.get('distribution', 'fixed')
+        if distribution == 'uniform':
+            value = self.random.uniform(latency.get('min', 0.0), latency.get('max', 1.0))
+        elif distribution == 'normal':
+            value = self.random.gauss(latency.get('mean', 0.5), latency.get('stddev', 0.1))
+        elif distribution == 'lognormal':
+            # Parameterized by the median and sigma of the underlying normal
+            value = latency.get('median', 0.5) * self.random.lognormvariate(0.0, latency.get('sigma', 0.5))
+        else:
+            value = latency.get('mean', 0.0)
+        return max(0.0, value)
+
+    def _check_failure(self):
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            raise MockAPIError(429, retry_after=self.retry_after)
+        if roll < self.rate_limit_rate + self.error_rate:
+            raise MockAPIError(500)
+
+    def _response(self, prompt, response_length):
+        settings = RESPONSE_LENGTH_SETTINGS.get(response_length, RESPONSE_LENGTH_SETTINGS["medium"])
+        low, high = self.response_fill
+        size = max(1, int(settings["max_tokens"] * self.random.uniform(low, high)))
+        body = (MOCK_FILLER * (size // len(MOCK_FILLER) + 1))[:size]
+        # Answer moderator decision prompts in their tag format so speaker parsing is exercised too
+        match = re.search(r'利用可能な発言者: (.*)', prompt)
+        if match:
+            speaker = self.random.choice(match.group(1).split(", "))
+            return f"<呼びかけ>次は {speaker} さん、お願いします\n<簡単な説明>{body}\n<質問>{body[:20]}？"
+        return body
+
+    def _cached_tokens(self, prompt, model_name):
+        if not self.prompt_cache:
+            return 0
+        settings = self.prompt_cache if isinstance(self.prompt_cache, dict) else {}
+        recent = self._recent_prompts.setdefault(model_name, collections.deque(maxlen=settings.get('entries', 64)))
+        shared = max((_common_prefix_length(previous, prompt) for previous in recent), default=0)
+        recent.append(prompt)
+        tokens = DEFAULT_TOKEN_COUNTER.count(prompt[:shared])
+        if tokens < settings.get('min_tokens', 1024):
+            return 0
+        return tokens - tokens % settings.get('block_tokens', 128)
+
+    def _plan(self, prompt, model_name, response_length):
+        """Returns (response text, time to first token, seconds per chunk of MOCK_CHUNK_SIZE)."""
+        self._check_failure()
+        text = self._response(prompt, response_length)
+        report_usage(self.api_type, model_name, DEFAULT_TOKEN_COUNTER.count(prompt),
+                     DEFAULT_TOKEN_COUNTER.count(text), self._cached_tokens(prompt, model_name))
+        chunk_time = MOCK_CHUNK_SIZE / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        return text, self._first_token_latency(), chunk_time
+
+    def generate(self, prompt, model_name, response_length="medium"):
+        text, first_token, chunk_time = self._plan(prompt, model_name, response_length)
+        time.sleep(first_token + chunk_time * len(text) / MOCK_CHUNK_SIZE)
+        return text
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        async with request_slot(self.api_type):
+            text, first_token, chunk_time = self._plan(prompt, model_name, response_length)
+            await asyncio.sleep(first_token + chunk_time * len(text) / MOCK_CHUNK_SIZE)
+            return text
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        text, first_token, chunk_time = self._plan(prompt, model_name, response_length)
+        time.sleep(first_token)
+        for start in range(0, len(text), MOCK_CHUNK_SIZE):
+            yield text[start:start + MOCK_CHUNK_SIZE]
+            time.sleep(chunk_time)
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        async with request_slot(self.api_type):
+            text, first_token, chunk_time = self._plan(prompt, model_name, response_length)
+            await asyncio.sleep(first_token)
+            for start in range(0, len(text), MOCK_CHUNK_SIZE):
+                yield text[start:start + MOCK_CHUNK_SIZE]
+                await asyncio.sleep(chunk_time)
+
 class GeminiAPI:
+    api_type = "gemini"
+
+    @staticmethod
+    def load_sdk():
+        global genai
+        import google.generativeai as genai
+
     def __init__(self):
         debug_print("GeminiAPI __init__ called")
         api_key = os.getenv("GEMINI_API_KEY")
@@ -85,47 +383,217 @@ class GeminiAPI:
             raise ValueError("GEMINI_API_KEY environment variable not set.")
         genai.configure(api_key=api_key)
 
-    def generate(self, prompt, model_name, response_length="medium"):
+    def _build_request(self, prompt, model_name, response_length):
         settings = RESPONSE_LENGTH_SETTINGS.get(response_length, RESPONSE_LENGTH_SETTINGS["medium"])
         instruction = settings["instruction"]
         max_tokens = settings.get("max_tokens", 150)
         temperature = settings.get("temperature", 0.7)
         top_p = settings.get("top_p", 1.0)
 
-        full_prompt = f"{prompt}\n\n{instruction}"
+        debug_print(f"GeminiAPI generate called with model '{model_name}', length '{response_length}' and prompt: {prompt[:100]}...")
+
+        generation_config = genai.types.GenerationConfig(
+            max_output_tokens=max_tokens,
+            temperature=temperature,
+            top_p=top_p
+        )
+        chat_messages = getattr(prompt, 'messages', None)
+        if chat_messages is None:
+            return f"{prompt}\n\n{instruction}", generation_config, None
+
+        # ChatPrompt: system instruction on the model, history as contents.
+        # Consecutive messages of the same role are merged into one content with several parts.
+        contents = []
+        for message in chat_messages:
+            role = "model" if message["role"] == "assistant" else "user"
+            if contents and contents[-1]["role"] == role:
+                contents[-1]["parts"].append(message["content"])
+            else:
+                contents.append({"role": role, "parts": [message["content"]]})
+        return contents, generation_config, f"{prompt.system}\n\n{instruction}"
+
+    def _model(self, model_name, system_instruction=None):
+        # GenerativeModel handles are reused instead of being rebuilt on every call.
+        # The system instruction is fixed per handle, so each distinct one gets its own;
+        # the pool keeps only the most recently used ones (MAX_MODEL_HANDLES).
+        if system_instruction is None:
+            return CLIENT_POOL.model_handle(self.api_type, model_name, genai.GenerativeModel)
+        return CLIENT_POOL.model_handle(
+            self.api_type, (model_name, system_instruction),
+            lambda key: genai.GenerativeModel(model_name, system_instruction=system_instruction)
+        )
+
+    # Errors propagate to the RequestScheduler, which retries or fails over.
 
-        debug_print(f"GeminiAPI generate called with model '{model_name}', length '{response_length}' and prompt: {full_prompt[:100]}...")
+    def _report_usage(self, model_name, response):
+        usage = getattr(response, "usage_metadata", None)
+        if usage is not None:
+            report_usage(self.api_type, model_name, usage.prompt_token_count, usage.candidates_token_count,
+                         getattr(usage, "cached_content_token_count", 0))
 
-        try:
-            model = genai.GenerativeModel(model_name)
-            response = model.generate_content(
+    def generate(self, prompt, model_name, response_length="medium"):
+        full_prompt, generation_config, system_instruction = self._build_request(prompt, model_name, response_length)
+        model = self._model(model_name, system_instruction)
+        response = model.generate_content(
+            full_prompt,
+            generation_config=generation_config,
+            request_options={"timeout": CLIENT_POOL.timeout(self.api_type)}
+        )
+        self._report_usage(model_name, response)
+        return response.text
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        full_prompt, generation_config, system_instruction = self._build_request(prompt, model_name, response_length)
+        model = self._model(model_name, system_instruction)
+        async with request_slot(self.api_type):
+            response = await model.generate_content_async(
+                full_prompt,
+                generation_config=generation_config,
+                request_options={"timeout": CLIENT_POOL.timeout(self.api_type)}
+            )
+        self._report_usage(model_name, response)
+        return response.text
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        """Yields the response text in chunks as they arrive."""
+        full_prompt, generation_config, system_instruction = self._build_request(prompt, model_name, response_length)
+        model = self._model(model_name, system_instruction)
+        response = model.generate_content(
+            full_prompt,
+            generation_config=generation_config,
+            request_options={"timeout": CLIENT_POOL.timeout(self.api_type)},
+            stream=True
+        )
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+            # Every chunk carries the usage so far; the last one has the totals
+            self._report_usage(model_name, chunk)
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        full_prompt, generation_config, system_instruction = self._build_request(prompt, model_name, response_length)
+        model = self._model(model_name, system_instruction)
+        async with request_slot(self.api_type):
+            response = await model.generate_content_async(
                 full_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    max_output_tokens=max_tokens,
-                    temperature=temperature,
-                    top_p=top_p
-                )
+                generation_config=generation_config,
+                request_options={"timeout": CLIENT_POOL.timeout(self.api_type)},
+                stream=True
             )
-            return response.text
-        except Exception as e:
-            debug_print(f"Error calling Gemini API: {e}")
-            return f"[Gemini API Error]: {e}"
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+                self._report_usage(model_name, chunk)
+
+
+async def agenerate_streamed(client, prompt, model_name, response_length, on_chunk):
+    """Streams a response, passing each chunk to on_chunk, and returns the full text."""
+    chunks = []
+    async for chunk in client.astream(prompt, model_name, response_length):
+        chunks.append(chunk)
+        on_chunk(chunk)
+    return "".join(chunks)
 
 
-API_CLIENTS = {
-    "openai": OpenAIAPI(),
-    "deepseek": DeepSeekAPI(),
-    "gemini": GeminiAPI(),
+API_PROVIDERS = {
+    "openai": OpenAIAPI,
+    "deepseek": DeepSeekAPI,
+    "gemini": GeminiAPI,
+    "mock": MockAPI,
 }
 
+# Client instances, created on first use by get_api_client()
+API_CLIENTS = {}
+
+# Seconds spent importing the SDK and constructing the client, per provider
+PROVIDER_STARTUP_TIMES = {}
+
+def get_api_client(api_type):
+    client = API_CLIENTS.get(api_type)
+    if client is None:
+        if api_type not in API_PROVIDERS:
+            raise ValueError(f"Unknown API type '{api_type}'.")
+        provider_class = API_PROVIDERS[api_type]
+        started_at = time.perf_counter()
+        provider_class.load_sdk()
+        imported_at = time.perf_counter()
+        client = provider_class()
+        initialized_at = time.perf_counter()
+        PROVIDER_STARTUP_TIMES[api_type] = {
+            "import": imported_at - started_at,
+            "init": initialized_at - imported_at,
+        }
+        API_CLIENTS[api_type] = client
+        debug_print(f"Initialized {api_type} client in {initialized_at - started_at:.3f}s")
+    return client
+
+def print_startup_profile(total_seconds=None):
+    print("\n--- Startup Profile ---")
+    for api_type, times in PROVIDER_STARTUP_TIMES.items():
+        print(f"{api_type}: import {times['import'] * 1000:.1f} ms, init {times['init'] * 1000:.1f} ms")
+    if total_seconds is not None:
+        print(f"Total startup: {total_seconds * 1000:.1f} ms")
+    print("-----------------------")
+
 LLM_API_MAP = {}
 
-def initialize_llm_api_map(models_config):
+# Used when a models.yaml entry has no context_window
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Tokens kept free in the context window for the prompt template, persona and topic
+PROMPT_RESERVE_TOKENS = 1000
+
+def model_token_counters():
+    """Returns {model key: token counter} for every initialized model."""
+    return {model_key: entry['token_counter'] for model_key, entry in LLM_API_MAP.items()}
+
+def history_token_budget(model_key, response_length, max_history_tokens):
+    """Tokens of history that fit in the model's context window next to the prompt and response."""
+    entry = LLM_API_MAP[model_key]
+    settings = RESPONSE_LENGTH_SETTINGS.get(response_length, RESPONSE_LENGTH_SETTINGS["medium"])
+    available = entry['context_window'] - settings['max_tokens'] - PROMPT_RESERVE_TOKENS
+    return max(0, min(max_history_tokens, available))
+
+def initialize_llm_api_map(models_config, cache=None, replay=False):
+    """Maps model keys from models.yaml to API clients.
+
+    Every client is wrapped in a ScheduledClient (rate limits, retries and
+    failover to the model's `fallback`). If a ResponseCache is given, that is
+    wrapped in turn in a CachedClient; replay=True serves responses from the
+    cache only. The outermost MeteredClient records every call in TELEMETRY.
+    """
     global LLM_API_MAP
+    CLIENT_POOL.configure(models_config.get('providers'))
+    SCHEDULER.configure(models_config.get('scheduler'))
+    TELEMETRY.configure(models_config)
+    # Optional per-provider overrides, e.g. providers: {openai: {max_concurrency: 4, rpm: 500}}
+    for api_type, provider_settings in (models_config.get('providers') or {}).items():
+        if 'max_concurrency' in provider_settings:
+            PROVIDER_CONCURRENCY[api_type] = int(provider_settings['max_concurrency'])
+        SCHEDULER.limiter.configure(("provider", api_type), provider_settings.get('rpm'), provider_settings.get('tpm'))
+    set_global_concurrency(GLOBAL_CONCURRENCY)
+
     for model_name, details in models_config['models'].items():
         api_type = details['api']
+        fallback = details.get('fallback')
+        if fallback is not None and fallback not in models_config['models']:
+            raise ValueError(f"Model '{model_name}' has unknown fallback '{fallback}'.")
+        token_counter = get_token_counter(details)
+        client = None
+        # Replay never calls the provider, so its SDK is not even loaded
+        if not replay:
+            client = ScheduledClient(get_api_client(api_type), SCHEDULER, model_name, details['name'], api_type,
+                                     token_counter, RESPONSE_LENGTH_SETTINGS, fallback=fallback)
+            SCHEDULER.register(client)
+            SCHEDULER.limiter.configure(("model", model_name), details.get('rpm'), details.get('tpm'))
+        if cache is not None:
+            client = CachedClient(client, cache, RESPONSE_LENGTH_SETTINGS, api_type, replay=replay)
+        client = MeteredClient(client, TELEMETRY, model_name, api_type, details['name'], token_counter)
         LLM_API_MAP[model_name] = {
-            "client": API_CLIENTS[api_type],
-            "model_name_for_api": details['name']
+            "client": client,
+            "model_name_for_api": details['name'],
+            "api": api_type,
+            "token_counter": token_counter,
+            "context_window": int(details.get('context_window', DEFAULT_CONTEXT_WINDOW))
         }
-    debug_print("LLM_API_MAP initialized:", LLM_API_MAP.keys())
\ No newline at end of file
+    debug_print("LLM_API_MAP initialized:", LLM_API_MAP.keys())
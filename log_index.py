@@ -0,0 +1,358 @@
+# log_index.py
+
+import argparse
+import json
+import mmap
+import os
+import re
+import sqlite3
+import time
+
+from utils import COLOR_RESET, COLOR_MODERATOR
+
+DEFAULT_INDEX_PATH = os.path.join('.cache', 'log_index.sqlite')
+
+# Same pattern main.topic_from_history uses on the opening moderator statement
+OPENING_TOPIC = re.compile(r'「(.*)」')
+# debate_<topic>_<YYYYmmdd>_<HHMMSS>[_suffix][-n].jsonl, see StateTracker._log_path
+LOG_FILENAME = re.compile(r'^debate_(.*?)_(\d{8})_(\d{6})(?:_[^-.]+)?(?:-\d+)?\.jsonl$')
+
+# The trigram tokenizer needs at least 3 characters; shorter text filters use LIKE
+MIN_FTS_QUERY_LENGTH = 3
+# Messages inserted per executemany() while ingesting a file
+INSERT_BATCH_SIZE = 2000
+# Upper bounds (exclusive, in characters) of the response length histogram buckets
+LENGTH_BUCKETS = [32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, inode INTEGER NOT NULL,
+    size INTEGER NOT NULL, offset INTEGER NOT NULL, topic TEXT, started TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, round INTEGER, speaker TEXT,
+    text TEXT NOT NULL, length INTEGER NOT NULL, metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_file ON messages(file_id);
+CREATE INDEX IF NOT EXISTS messages_speaker ON messages(speaker, length);
+CREATE INDEX IF NOT EXISTS messages_round ON messages(round);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+def iter_log_lines(path, offset=0):
+    """Yields (offset after the line, raw line) for each complete line from `offset` on.
+
+    The file is memory-mapped, so only the pages actually read are loaded. An
+    unterminated last line (a debate still being written, or a torn write) is
+    not yielded and will be picked up by the next update.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= offset:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = offset
+            while True:
+                end = mapped.find(b'\n', position)
+                if end < 0:
+                    return
+                yield end + 1, mapped[position:end]
+                position = end + 1
+
+def parse_log_filename(filename):
+    """Returns (topic as sanitized in the filename, start time as "YYYY-mm-dd HH:MM:SS") or (None, None)."""
+    match = LOG_FILENAME.match(filename)
+    if not match:
+        return None, None
+    topic, day, clock = match.groups()
+    return topic, f"{day[:4]}-{day[4:6]}-{day[6:]} {clock[:2]}:{clock[2:4]}:{clock[4:]}"
+
+def _like_pattern(text):
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+class LogIndex:
+    """Incremental SQLite full-text index over the JSONL debate logs in a directory.
+
+    Each log's indexed byte offset is stored, so an update only reads what
+    was appended since the last one; logs are append-only (see LogWriter).
+    A log that shrank or was replaced (resume_log truncates a torn tail) is
+    reindexed from the start, and logs that were deleted are dropped.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH, logs_dir='logs'):
+        self.logs_dir = logs_dir
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def update(self):
+        """Indexes new logs and lines appended to known ones. Returns a stats dict."""
+        stats = {'files': 0, 'updated': 0, 'reindexed': 0, 'removed': 0, 'messages': 0, 'skipped_lines': 0}
+        known = {path: (file_id, inode, size, offset)
+                 for file_id, path, inode, size, offset in self._db.execute("SELECT id, path, inode, size, offset FROM files")}
+        present = set()
+        if os.path.isdir(self.logs_dir):
+            for filename in sorted(os.listdir(self.logs_dir)):
+                if not filename.endswith('.jsonl'):
+                    continue
+                # Stored resolved, so `--logs-dir logs` and an absolute --logs-dir share one entry per log
+                path = os.path.realpath(os.path.join(self.logs_dir, filename))
+                present.add(path)
+                stats['files'] += 1
+                self._update_file(path, filename, known.get(path), stats)
+
+        # The index is shared by all log directories, so only logs of this one can have been deleted
+        logs_dir = os.path.join(os.path.realpath(self.logs_dir), '')
+        for path in set(known) - present:
+            if not path.startswith(logs_dir):
+                continue
+            file_id = known[path][0]
+            self._db.execute("DELETE FROM messages WHERE file_id = ?", (file_id,))
+            self._db.execute("DELETE FROM files WHERE id = ?", (file_id,))
+            stats['removed'] += 1
+        self._db.commit()
+        return stats
+
+    def _update_file(self, path, filename, known, stats):
+        try:
+            status = os.stat(path)
+        except OSError:
+            return # Removed while scanning
+        if known is not None:
+            file_id, inode, size, offset = known
+            if inode == status.st_ino and status.st_size == offset:
+                return # Nothing appended since the last update
+            if inode != status.st_ino or status.st_size < offset:
+                self._db.execute("DELETE FROM messages WHERE file_id = ?", (file_id,))
+                offset = 0
+                stats['reindexed'] += 1
+            topic, started = self._db.execute("SELECT topic, started FROM files WHERE id = ?", (file_id,)).fetchone()
+        else:
+            file_id, offset = None, 0
+            topic, started = parse_log_filename(filename)
+            if started is None:
+                started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(status.st_mtime))
+
+        if file_id is None:
+            file_id = self._db.execute(
+                "INSERT INTO files (path, inode, size, offset, topic, started) VALUES (?, ?, 0, 0, ?, ?)",
+                (path, status.st_ino, topic, started)
+            ).lastrowid
+
+        rows = []
+        added = 0
+        indexed_offset = offset
+        for end_offset, line in iter_log_lines(path, offset):
+            indexed_offset = end_offset
+            try:
+                entry = json.loads(line)
+                if 'summary' in entry and 'speaker' not in entry:
+                    continue # Rolling summary update, not a message
+                round_num, speaker, text = entry['round'], entry['speaker'], entry['text']
+            except (ValueError, KeyError, TypeError):
+                stats['skipped_lines'] += 1
+                continue
+            if round_num == 0 and not added and offset == 0:
+                # The opening statement has the exact topic; the filename only a sanitized one
+                match = OPENING_TOPIC.search(text)
+                if match:
+                    topic = match.group(1)
+            metadata = {key: value for key, value in entry.items() if key not in ('round', 'speaker', 'text')}
+            rows.append((file_id, round_num, speaker, text, len(text),
+                         json.dumps(metadata, ensure_ascii=False) if metadata else None))
+            added += 1
+            if len(rows) >= INSERT_BATCH_SIZE:
+                self._insert(rows)
+                rows = []
+        self._insert(rows)
+
+        # Rows and the new offset are committed together, so an interrupted update never double-indexes
+        self._db.execute(
+            "UPDATE files SET inode = ?, size = ?, offset = ?, topic = ? WHERE id = ?",
+            (status.st_ino, indexed_offset, indexed_offset, topic, file_id)
+        )
+        self._db.commit()
+        if added:
+            stats['updated'] += 1
+        stats['messages'] += added
+
+    def _insert(self, rows):
+        if not rows:
+            return
+        last_id = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        self._db.executemany(
+            "INSERT INTO messages (file_id, round, speaker, text, length, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        # One bulk insert per batch is ~2x faster than a per-row trigger with the trigram tokenizer
+        self._db.execute("INSERT INTO messages_fts(rowid, text) SELECT id, text FROM messages WHERE id > ?", (last_id,))
+
+    @staticmethod
+    def _where(topic=None, speakers=None, rounds=None, text=None):
+        """SQL condition and parameters for the query filters (messages m JOIN files f)."""
+        conditions, params = [], []
+        if topic:
+            conditions.append("f.topic LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(topic))
+        if speakers:
+            conditions.append(f"m.speaker IN ({', '.join('?' * len(speakers))})")
+            params.extend(speakers)
+        if rounds is not None:
+            conditions.append("m.round BETWEEN ? AND ?")
+            params.extend(rounds)
+        if text:
+            if len(text) >= MIN_FTS_QUERY_LENGTH:
+                conditions.append("m.id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+                params.append('"' + text.replace('"', '""') + '"')
+            else:
+                conditions.append("m.text LIKE ? ESCAPE '\\'")
+                params.append(_like_pattern(text))
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    def search(self, limit=20, **filters):
+        """Returns matching messages as dicts, most recent debates first."""
+        where, params = self._where(**filters)
+        query = (
+            "SELECT f.path, f.topic, f.started, m.round, m.speaker, m.text FROM messages m"
+            f" JOIN files f ON f.id = m.file_id{where} ORDER BY f.started DESC, f.id DESC, m.id LIMIT ?"
+        )
+        columns = ('path', 'topic', 'started', 'round', 'speaker', 'text')
+        return [dict(zip(columns, row)) for row in self._db.execute(query, params + [limit])]
+
+    def speaker_stats(self, **filters):
+        """Per speaker: turns, debates and response length (characters) avg/p50/p90/max.
+
+        Computed from the indexed lengths; the raw logs are not read.
+        """
+        where, params = self._where(**filters)
+        stats = {}
+        query = (
+            "SELECT m.speaker, m.length, m.file_id FROM messages m"
+            f" JOIN files f ON f.id = m.file_id{where} ORDER BY m.speaker, m.length"
+        )
+        for speaker, length, file_id in self._db.execute(query, params):
+            entry = stats.setdefault(speaker, {'lengths': [], 'debates': set()})
+            entry['lengths'].append(length)
+            entry['debates'].add(file_id)
+        result = {}
+        for speaker, entry in stats.items():
+            lengths = entry['lengths'] # Already sorted by the query
+            result[speaker] = {
+                'turns': len(lengths),
+                'debates': len(entry['debates']),
+                'avg': sum(lengths) / len(lengths),
+                'p50': lengths[len(lengths) // 2],
+                'p90': lengths[min(len(lengths) - 1, int(len(lengths) * 0.9))],
+                'max': lengths[-1],
+            }
+        return result
+
+    def length_histogram(self, **filters):
+        """Returns [(bucket upper bound, count)] over LENGTH_BUCKETS; the bound is None for longer responses."""
+        where, params = self._where(**filters)
+        bucket = "CASE " + " ".join(f"WHEN m.length < {bound} THEN {bound}" for bound in LENGTH_BUCKETS) + " END"
+        query = (
+            f"SELECT {bucket} AS bucket, COUNT(*) FROM messages m JOIN files f ON f.id = m.file_id{where}"
+            " GROUP BY bucket ORDER BY bucket IS NULL, bucket"
+        )
+        return self._db.execute(query, params).fetchall()
+
+    def totals(self, **filters):
+        where, params = self._where(**filters)
+        return self._db.execute(
+            f"SELECT COUNT(DISTINCT m.file_id), COUNT(*) FROM messages m JOIN files f ON f.id = m.file_id{where}",
+            params
+        ).fetchone()
+
+def parse_rounds(value):
+    """'3' -> (3, 3), '2-5' -> (2, 5)."""
+    try:
+        low, _, high = value.partition('-')
+        return int(low), int(high or low)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid round '{value}', expected N or N-M.")
+
+def print_update_stats(stats, elapsed):
+    print(f"Indexed {stats['messages']} new messages from {stats['updated']} of {stats['files']} logs"
+          f" in {elapsed:.2f}s (reindexed: {stats['reindexed']}, removed: {stats['removed']},"
+          f" skipped lines: {stats['skipped_lines']})")
+
+def print_search_results(results, text=None):
+    for result in results:
+        snippet = result['text'].replace('\n', ' ')
+        if text and text in snippet:
+            start = max(0, snippet.index(text) - 40)
+            snippet = ("…" if start else "") + snippet[start:start + 120]
+            snippet = snippet.replace(text, f"{COLOR_MODERATOR}{text}{COLOR_RESET}")
+        elif len(snippet) > 120:
+            snippet = snippet[:120] + "…"
+        print(f"{result['started']}  {result['topic']}  [Round {result['round']}] {result['speaker']}: {snippet}")
+        print(f"    {result['path']}")
+    print(f"({len(results)} results)")
+
+def print_stats(index, filters):
+    debates, messages = index.totals(**filters)
+    print("\n--- Debate Log Statistics ---")
+    print(f"Debates: {debates}, messages: {messages}")
+    print(f"{'speaker':<16}{'turns':>7}{'debates':>9}{'avg len':>9}{'p50':>7}{'p90':>7}{'max':>7}")
+    stats = index.speaker_stats(**filters)
+    for speaker, row in sorted(stats.items(), key=lambda item: -item[1]['turns']):
+        print(f"{speaker:<16}{row['turns']:>7}{row['debates']:>9}{row['avg']:>9.0f}{row['p50']:>7}{row['p90']:>7}{row['max']:>7}")
+
+    histogram = index.length_histogram(**filters)
+    if histogram:
+        print("\nResponse length (characters):")
+        widest = max(count for _, count in histogram)
+        for upper, count in histogram:
+            lower = ([0] + [bound for bound in LENGTH_BUCKETS if upper is None or bound < upper])[-1]
+            label = f"{lower}-{upper - 1}" if upper is not None else f"{lower}+"
+            bar = "#" * max(1, round(count / widest * 40))
+            print(f"  {label:>10}{count:>7}  {bar}")
+    print("-----------------------------")
+
+def main():
+    parser = argparse.ArgumentParser(description='Full-text index and statistics over the debate logs.')
+    parser.add_argument('--logs-dir', type=str, default='logs', help='Directory of debate_*.jsonl logs.')
+    parser.add_argument('--index', type=str, default=DEFAULT_INDEX_PATH, help='SQLite file for the index.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('update', help='Index new logs and new lines of known logs.')
+    for name, help_text in (('search', 'List matching messages.'), ('stats', 'Turns per speaker and response lengths.')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('--text', type=str, default=None, help='Substring to search for in the messages.')
+        command.add_argument('--topic', type=str, default=None, help='Substring of the debate topic.')
+        command.add_argument('--speaker', type=str, action='append', default=None, help='Speaker name (repeatable).')
+        command.add_argument('--round', dest='rounds', type=parse_rounds, default=None, help='Round N or range N-M.')
+        command.add_argument('--no-update', action='store_true', help='Query the index as is, without indexing new logs first.')
+        if name == 'search':
+            command.add_argument('--limit', type=int, default=20, help='Maximum number of results.')
+    args = parser.parse_args()
+
+    index = LogIndex(args.index, args.logs_dir)
+    try:
+        if args.command == 'update' or not args.no_update:
+            started_at = time.perf_counter()
+            stats = index.update()
+            if args.command == 'update' or stats['messages'] or stats['removed']:
+                print_update_stats(stats, time.perf_counter() - started_at)
+        if args.command == 'update':
+            return
+
+        filters = {'topic': args.topic, 'speakers': args.speaker, 'rounds': args.rounds, 'text': args.text}
+        if args.command == 'search':
+            print_search_results(index.search(limit=args.limit, **filters), args.text)
+        else:
+            print_stats(index, filters)
+    finally:
+        index.close()
+
+if __name__ == '__main__':
+    main()
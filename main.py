@@ -1,4 +1,7 @@
 import argparse
+import asyncio
+import re
+import time
 import yaml
 import os
 
@@ -6,30 +9,70 @@ from moderator_engine import ModeratorEngine
 from agent_engine import AgentEngine
 from state_tracker import StateTracker
 from llm_api import initialize_llm_api_map, LLM_API_MAP
-from utils import debug_print, DEBUG_MODE, COLOR_RESET, COLOR_MODERATOR, COLOR_AGENT_A, COLOR_AGENT_B, COLOR_AGENT_C
+from debate_runner import run_debate, print_timing_report
+from batch_runner import load_batch_jobs, run_batch, print_batch_report
+from debate_daemon import DebateDaemon, DEFAULT_LISTEN
+from response_cache import ResponseCache
+from speculation import Speculator
+from speaker_policy import SPEAKER_POLICIES, make_speaker_policy
+import llm_api
+from utils import debug_print, DEBUG_MODE
 
 def load_config(config_path):
     with open(config_path, 'r', encoding='utf-8') as f:
         return yaml.safe_load(f)
 
+def topic_from_history(history):
+    """Recovers the topic from the opening moderator statement of a logged debate."""
+    match = re.search(r'「(.*)」', history[0]['text']) if history else None
+    if not match:
+        raise ValueError("Could not determine the topic from the resumed log.")
+    return match.group(1)
+
 def main():
     global DEBUG_MODE
+    started_at = time.perf_counter()
 
     parser = argparse.ArgumentParser(description='CLI-based AI Discussion Platform.')
-    parser.add_argument('--topic', type=str, required=True, help='The topic of the discussion.')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--topic', type=str, help='The topic of the discussion.')
+    source.add_argument('--batch', type=str, help='YAML file of debates to run concurrently (batch mode).')
+    source.add_argument('--resume', type=str, help='Continue an interrupted debate from its JSONL log.')
+    source.add_argument('--serve', action='store_true', help='Run as a daemon that accepts debate jobs from debate_client.py.')
     parser.add_argument('--rounds', type=int, default=5, help='Number of discussion rounds.')
     parser.add_argument('--debug', action='store_true', help='Enable debug output.')
     parser.add_argument('--summarize-rounds', action='store_true', help='Moderator summarizes each round.')
     parser.add_argument('--conversation-mode', action='store_true', help='Enable conversation-like discussion mode.')
+    parser.add_argument('--log-flush-every', type=int, default=1, help='Flush the streaming log every N messages.')
+    parser.add_argument('--log-fsync', action='store_true', help='fsync the streaming log on every flush.')
+    parser.add_argument('--speaker-policy', type=str, default=None, choices=sorted(SPEAKER_POLICIES),
+                        help='Choose speakers locally instead of asking the moderator LLM.')
+    parser.add_argument('--moderator-every', type=int, default=0, metavar='N',
+                        help='With --speaker-policy, still ask the moderator LLM every N rounds (0 = never).')
+    parser.add_argument('--panel', action='store_true', help='Panel mode: every agent answers the moderator\'s question concurrently each round.')
+    parser.add_argument('--speculate', type=int, default=0, metavar='N', help='Pre-generate up to N likely agent responses while the moderator decides (0 = off).')
+    parser.add_argument('--stream', action='store_true', help='Stream responses to the terminal as they are generated and record TTFT per turn.')
+    parser.add_argument('--spill-after', type=int, default=None, help='Keep at most ~2N turns in memory and spill older ones to disk (long conversation-mode sessions).')
+    parser.add_argument('--workers', type=int, default=4, help='Number of debates run concurrently in batch and daemon mode.')
+    parser.add_argument('--listen', type=str, default=DEFAULT_LISTEN, help='HOST:PORT the daemon listens on (daemon mode).')
+    parser.add_argument('--socket', type=str, default=None, help='Listen on this Unix socket instead of TCP (daemon mode).')
+    parser.add_argument('--max-queue', type=int, default=16, help='Jobs that may wait for a worker before new ones are rejected (daemon mode).')
+    parser.add_argument('--max-inflight', type=int, default=None, help='Global cap on concurrent LLM requests.')
+    parser.add_argument('--cache', action='store_true', help='Reuse cached responses for identical requests and cache new ones.')
+    parser.add_argument('--replay', action='store_true', help='Serve responses from the cache only (offline); misses are errors.')
+    parser.add_argument('--pool-stats', action='store_true', help='Report reused vs. created model handles and HTTP connections.')
+    parser.add_argument('--scheduler-stats', action='store_true', help='Report rate-limit waits, retries, hedged requests and failovers.')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Append one JSON record per LLM call (and per round) to this file.')
+    parser.add_argument('--prometheus-file', type=str, default=None, help='Write call, token, cost and latency metrics in Prometheus textfile format.')
+    parser.add_argument('--metrics-summary', action='store_true', help='Print calls, tokens, latency and estimated cost per role and model.')
+    parser.add_argument('--startup-profile', action='store_true', help='Report SDK import and client initialization time per provider.')
+    parser.add_argument('--cache-path', type=str, default=os.path.join('.cache', 'responses.sqlite'), help='SQLite file for the response cache.')
     args = parser.parse_args()
 
     DEBUG_MODE = args.debug
 
     print(f"Conversation Mode: {args.conversation_mode}")
 
-    print(f"Discussion Topic: {args.topic}")
-    print(f"Number of Rounds: {args.rounds}")
-
     # Load agents configuration
     agents_config_path = os.path.join(os.path.dirname(__file__), 'config', 'agents.yaml')
     agents_config = load_config(agents_config_path)
@@ -39,7 +82,66 @@ def main():
     models_config = load_config(models_config_path)
 
     # Initialize LLM_API_MAP with models configuration
-    initialize_llm_api_map(models_config)
+    if args.max_inflight is not None:
+        llm_api.set_global_concurrency(args.max_inflight)
+    response_cache = None
+    if args.cache or args.replay:
+        response_cache = ResponseCache(args.cache_path)
+    initialize_llm_api_map(models_config, cache=response_cache, replay=args.replay)
+    llm_api.TELEMETRY.open(args.metrics_file, args.prometheus_file)
+
+    if args.startup_profile:
+        llm_api.print_startup_profile(time.perf_counter() - started_at)
+
+    if args.serve:
+        default_mode = "panel" if args.panel else "conversation" if args.conversation_mode else "debate"
+        daemon = DebateDaemon(agents_config, workers=args.workers, max_queue=args.max_queue, default_rounds=args.rounds,
+                              summarize_rounds=args.summarize_rounds, default_mode=default_mode)
+        try:
+            asyncio.run(daemon.serve(args.listen, args.socket))
+        except KeyboardInterrupt:
+            print("\nDebate daemon stopped.")
+        finally:
+            llm_api.TELEMETRY.close()
+        if response_cache is not None:
+            response_cache.print_report()
+        if args.scheduler_stats:
+            llm_api.SCHEDULER.print_report()
+        if args.metrics_summary:
+            llm_api.TELEMETRY.print_report()
+        return
+
+    if args.batch:
+        jobs = load_batch_jobs(load_config(args.batch), args.rounds)
+        print(f"Batch: {len(jobs)} debates, {args.workers} workers")
+        try:
+            stats = asyncio.run(run_batch(
+                jobs, agents_config, workers=args.workers, summarize_rounds=args.summarize_rounds,
+                conversation_mode=args.conversation_mode
+            ))
+        finally:
+            llm_api.TELEMETRY.close()
+        print_batch_report(stats)
+        if response_cache is not None:
+            response_cache.print_report()
+        if args.pool_stats:
+            llm_api.CLIENT_POOL.print_report()
+        if args.scheduler_stats:
+            llm_api.SCHEDULER.print_report()
+        if args.metrics_summary:
+            llm_api.TELEMETRY.print_report()
+        return
+
+    state_tracker = StateTracker(spill_after=args.spill_after, token_counters=llm_api.model_token_counters())
+    if args.resume:
+        restored = state_tracker.resume_log(args.resume, args.log_flush_every, args.log_fsync)
+        args.topic = topic_from_history(state_tracker.get_history())
+        print(f"Resumed {restored} messages from {args.resume}")
+    else:
+        state_tracker.start_log(args.topic, flush_every=args.log_flush_every, fsync=args.log_fsync)
+
+    print(f"Discussion Topic: {args.topic}")
+    print(f"Number of Rounds: {args.rounds}")
 
     moderator_config = agents_config['moderator']
     agent_configs = agents_config['agents']
@@ -50,48 +152,40 @@ def main():
         print(f"Agent: {agent['name']} ({agent['model']})")
     print("--------------------------")
 
-    moderator_engine = ModeratorEngine(moderator_config, args.conversation_mode)
+    speaker_policy = make_speaker_policy(args.speaker_policy) if args.speaker_policy else None
+    moderator_engine = ModeratorEngine(moderator_config, args.conversation_mode,
+                                       speaker_policy=speaker_policy, llm_every=args.moderator_every)
     agent_engine = AgentEngine(agent_configs, args.conversation_mode)
-    state_tracker = StateTracker()
-
-    # Initial moderator statement
-    initial_moderator_statement = f"本日は「{args.topic}」について議論します。"
-    state_tracker.add_message(0, moderator_config['name'], initial_moderator_statement)
-    print(f"{COLOR_MODERATOR}[Round 0] {moderator_config['name']}:{COLOR_RESET}\n> {initial_moderator_statement}")
-
-    for round_num in range(1, args.rounds + 1):
-        print(f"\n{COLOR_RESET}[Round {round_num}]{COLOR_RESET}")
-        
-        # Moderator decides next speaker
-        next_speaker_name, moderator_statement = moderator_engine.decide_next_speaker(
-            args.topic, state_tracker.get_recent_history(max_tokens=4000), round_num, agent_configs
-        )
-        state_tracker.add_message(round_num, moderator_config['name'], moderator_statement)
-        print(f"{COLOR_MODERATOR}[{moderator_config['name']}]:{COLOR_RESET}\n> {moderator_statement}")
-
-        # Agent responds
-        agent_response = agent_engine.get_agent_response(
-            next_speaker_name, args.topic, state_tracker.get_recent_history(max_tokens=4000)
-        )
-        state_tracker.add_message(round_num, next_speaker_name, agent_response)
-        
-        # Determine agent color
-        agent_color = COLOR_RESET
-        if next_speaker_name == "AI-A":
-            agent_color = COLOR_AGENT_A
-        elif next_speaker_name == "AI-B":
-            agent_color = COLOR_AGENT_B
-        elif next_speaker_name == "AI-C":
-            agent_color = COLOR_AGENT_C
-
-        print(f"{agent_color}[{next_speaker_name}]:{COLOR_RESET}\n> {agent_response}")
-
-        if args.summarize_rounds and round_num < args.rounds: # Summarize if not the last round
-            summary = moderator_engine.generate_summary(args.topic, state_tracker.get_history())
-            print(f"{COLOR_MODERATOR}[Moderator Summary]:{COLOR_RESET}\n> {summary}")
+
+    speculator = Speculator(moderator_engine, agent_engine, args.speculate) if args.speculate > 0 else None
+
+    try:
+        asyncio.run(run_debate(
+            args.topic, args.rounds, moderator_engine, agent_engine, state_tracker,
+            moderator_config, agent_configs, summarize_rounds=args.summarize_rounds, stream=args.stream,
+            speculator=speculator, panel=args.panel
+        ))
+    finally:
+        # Everything added so far is already on disk; make sure the tail is flushed
+        state_tracker.close_log()
+        llm_api.TELEMETRY.close()
 
     # Save logs
     state_tracker.save_logs(args.topic)
 
+    if args.stream:
+        print_timing_report(state_tracker)
+    if speculator is not None:
+        speculator.print_report()
+
+    if response_cache is not None:
+        response_cache.print_report()
+    if args.pool_stats:
+        llm_api.CLIENT_POOL.print_report()
+    if args.scheduler_stats:
+        llm_api.SCHEDULER.print_report()
+    if args.metrics_summary:
+        llm_api.TELEMETRY.print_report()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
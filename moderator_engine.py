@@ -1,11 +1,19 @@
 # moderator_engine.py
 
-from llm_api import LLM_API_MAP
+from llm_api import LLM_API_MAP, history_token_budget, agenerate_streamed
 import re
 from utils import debug_print # Import debug_print
+from state_tracker import ChatPrompt, render_history, render_history_messages
+from request_scheduler import LLMRequestError
+from speaker_policy import RoundRobinPolicy
+from telemetry import call_context
+
+# The rolling summary replaces older history in prompts, so it gets more room
+# than the one-shot "short" summary of generate_summary.
+ROLLING_SUMMARY_LENGTH = "medium"
 
 class ModeratorEngine:
-    def __init__(self, config, conversation_mode=False):
+    def __init__(self, config, conversation_mode=False, max_history_tokens=4000, speaker_policy=None, llm_every=0):
         self.name = config['name']
         self.model_key = config['model'] # This is the key from models.yaml (e.g., 'gpt-3.5-turbo')
         self.persona = config['persona']
@@ -13,50 +21,106 @@ class ModeratorEngine:
         self.model_name_for_api = LLM_API_MAP[self.model_key]['model_name_for_api']
         self.response_length = config.get('response_length', 'medium') # Get response_length from config
         self.conversation_mode = conversation_mode
+        self.max_history_tokens = max_history_tokens
+        # With a SpeakerPolicy, only every `llm_every`-th round asks the LLM
+        # (0 = never); the other rounds pick locally and use a templated statement.
+        self.speaker_policy = speaker_policy
+        self.llm_every = llm_every
+        # Picks the speaker when the LLM names no valid agent or is unavailable
+        self.fallback_policy = RoundRobinPolicy()
 
-    def decide_next_speaker(self, topic, history, current_round, agents, max_history_tokens=4000):
-        recent_history = history # history is already recent history from main.py
-        history_text = "\n".join([f"{item['speaker']}: {item['text']}" for item in recent_history])
-        valid_agent_names = [agent['name'] for agent in agents]
+    def uses_llm(self, current_round):
+        if self.speaker_policy is None:
+            return True
+        return self.llm_every > 0 and current_round % self.llm_every == 0
+
+    def local_decision(self, history, current_round, agents, policy=None):
+        """Chooses the next speaker with the speaker policy and returns (name, templated statement)."""
+        next_speaker_name = (policy or self.speaker_policy).choose(history, agents, current_round)
+        last_agent = next((item['speaker'] for item in reversed(history)
+                           if item['speaker'] in [agent['name'] for agent in agents]), None)
+        if self.conversation_mode:
+            if last_agent:
+                statement = f"{next_speaker_name}さん、今の{last_agent}さんの話、どう思いますか？"
+            else:
+                statement = f"{next_speaker_name}さん、このテーマについてどう思いますか？"
+        elif last_agent:
+            statement = f"{last_agent}さんの意見を受けて、次は {next_speaker_name} さん、お願いします。"
+        else:
+            statement = f"まずは {next_speaker_name} さん、あなたの意見をお聞かせください。"
+        return next_speaker_name, statement
+
+    def recent_history(self, state_tracker):
+        """Returns the history window sized for the context window of the moderator's model."""
+        budget = history_token_budget(self.model_key, self.response_length, self.max_history_tokens)
+        return state_tracker.get_recent_history(max_tokens=budget, model_key=self.model_key, use_summary=True)
+
+    def _build_decision_prompt(self, topic, history, current_round, agents):
         available_agents = ", ".join([agent['name'] for agent in agents])
 
+        # Everything that is fixed for the debate goes into the system prefix and the
+        # history follows as append-only messages, so consecutive rounds share a
+        # cacheable prefix. Only the round number comes after the history.
         if self.conversation_mode:
-            prompt = f"""
-あなたは会話の進行役です。以下の主題と過去の発言を元に、次に発言すべき人物を選び、自然な会話の流れで話を振ってください。直前の発言内容に触れつつ、次の発言者が意見を述べやすいように促してください。相手に完璧な回答を求めず、気軽に意見を引き出すように促してください。短い返答でも会話が続くように、柔軟に対応してください。
+            system = f"""あなたは会話の進行役です。以下の主題と過去の発言を元に、次に発言すべき人物を選び、自然な会話の流れで話を振ってください。直前の発言内容に触れつつ、次の発言者が意見を述べやすいように促してください。相手に完璧な回答を求めず、気軽に意見を引き出すように促してください。短い返答でも会話が続くように、柔軟に対応してください。
 
 利用可能な発言者: {available_agents}
 
 主題: {topic}
 
-過去の発言:
-{history_text}
-
-現在のラウンド: {current_round}
-
 回答形式:
 <呼びかけ>（例：「AI-Aさん、今のAI-Bさんの意見についてどう思われますか？」）
 <簡単な説明>（例：「AI-Bさんの意見を受けて、AI-Aさんの視点からさらに深掘りしたいです」）
 <質問>（例：「AIが教育に与える影響について、AI-Aさんの具体的な見解を聞かせていただけますか？」）
-"""
+
+過去の発言は「発言者: 内容」の形式で続きます。"""
         else:
-            prompt = f"""
-あなたは討論の司会者です。以下の主題と過去の発言を元に、次に発言すべき人物を選び、簡潔な理由を添えてその人物に話を振ってください。また、その人物にどのような質問をすべきか、短く具体的に提案してください。
+            system = f"""あなたは討論の司会者です。以下の主題と過去の発言を元に、次に発言すべき人物を選び、簡潔な理由を添えてその人物に話を振ってください。また、その人物にどのような質問をすべきか、短く具体的に提案してください。
 
 利用可能な発言者: {available_agents}
 
 主題: {topic}
 
-過去の発言:
-{history_text}
-
-現在のラウンド: {current_round}
-
 回答形式:
 <呼びかけ>（例：「次は AI-A さん、お願いします」）
 <簡単な説明>（例：「先ほどの意見に技術的な補足が必要だと感じました」）
 <質問>（例：「AIが教育に与える影響について、具体的な事例を挙げていただけますか？」）
-"""
-        llm_response = self.llm_client.generate(prompt, self.model_name_for_api, self.response_length)
+
+過去の発言は「発言者: 内容」の形式で続きます。"""
+        messages = render_history_messages(history)
+        messages.append({"role": "user", "content": f"現在のラウンド: {current_round}\n回答形式に従って、次の発言者に話を振ってください。"})
+        return ChatPrompt(system, messages)
+
+    def decide_next_speaker(self, topic, history, current_round, agents, max_history_tokens=4000):
+        prompt = self._build_decision_prompt(topic, history, current_round, agents)
+        try:
+            with call_context(role="moderator"):
+                llm_response = self.llm_client.generate(prompt, self.model_name_for_api, self.response_length)
+        except LLMRequestError as e:
+            return self._fallback_decision(e, history, current_round, agents)
+        return self._parse_decision(llm_response, history, agents)
+
+    async def adecide_next_speaker(self, topic, history, current_round, agents, max_history_tokens=4000, on_chunk=None):
+        """Async variant of decide_next_speaker. If on_chunk is given the raw response is streamed to it."""
+        prompt = self._build_decision_prompt(topic, history, current_round, agents)
+        try:
+            with call_context(role="moderator"):
+                if on_chunk is not None:
+                    llm_response = await agenerate_streamed(self.llm_client, prompt, self.model_name_for_api, self.response_length, on_chunk)
+                else:
+                    llm_response = await self.llm_client.agenerate(prompt, self.model_name_for_api, self.response_length)
+        except LLMRequestError as e:
+            return self._fallback_decision(e, history, current_round, agents)
+        return self._parse_decision(llm_response, history, agents)
+
+    def _fallback_decision(self, error, history, current_round, agents):
+        # The moderator model failed even after retries and failover: keep the debate going
+        # with a templated statement rather than putting the error text into the history.
+        debug_print(f"[DEBUG] Moderator LLM unavailable, choosing the next speaker locally: {error}")
+        return self.local_decision(history, current_round, agents, policy=self.speaker_policy or self.fallback_policy)
+
+    def _parse_decision(self, llm_response, history, agents):
+        valid_agent_names = [agent['name'] for agent in agents]
 
         # Parse LLM response to get next speaker and moderator statement
         lines = llm_response.split('\n')
@@ -85,22 +149,65 @@ class ModeratorEngine:
             next_speaker_name = match.group(1)
         else:
             # Fallback to cycling if no valid agent name is found in the response
-            if history:
-                last_speaker = history[-1]['speaker']
-                try:
-                    last_speaker_index = valid_agent_names.index(last_speaker)
-                    next_speaker_index = (last_speaker_index + 1) % len(valid_agent_names)
-                    next_speaker_name = valid_agent_names[next_speaker_index]
-                except ValueError:
-                    next_speaker_name = valid_agent_names[0] # If last speaker was moderator, pick first agent
-            else:
-                next_speaker_name = valid_agent_names[0] # First round, pick first agent
+            next_speaker_name = self.predict_next_speaker(history, agents)
 
         return next_speaker_name, moderator_statement
 
-    def generate_summary(self, topic, history, max_history_tokens=4000):
+    def predict_next_speaker(self, history, agents):
+        """The deterministic fallback choice: the agent after the last agent who spoke."""
+        return self.fallback_policy.choose(history, agents, None)
+
+    def _build_panel_prompt(self, topic, history, current_round, agents):
+        available_agents = ", ".join([agent['name'] for agent in agents])
+        role = "会話の進行役" if self.conversation_mode else "討論の司会者"
+
+        system = f"""あなたは{role}です。以下の主題と過去の発言を元に、参加者全員に投げかける質問を一つ、簡潔に提示してください。
+
+参加者: {available_agents}
+
+主題: {topic}
+
+回答形式:
+<質問>（例：「AIが教育に与える影響について、皆さんはどうお考えですか？」）
+
+過去の発言は「発言者: 内容」の形式で続きます。"""
+        messages = render_history_messages(history)
+        messages.append({"role": "user", "content": f"現在のラウンド: {current_round}\n回答形式に従って、全員への質問を提示してください。"})
+        return ChatPrompt(system, messages)
+
+    def _parse_panel_question(self, llm_response):
+        for line in llm_response.split('\n'):
+            if line.startswith('<質問>'):
+                return line.replace('<質問>', '').strip()
+        return llm_response.strip()
+
+    async def apose_panel_question(self, topic, history, current_round, agents):
+        """Returns one question addressed to every agent (panel mode)."""
+        if not self.uses_llm(current_round):
+            if current_round == 1:
+                return f"「{topic}」について、皆さんのご意見をお聞かせください。"
+            return "これまでの議論を踏まえて、皆さんの考えをお聞かせください。"
+        prompt = self._build_panel_prompt(topic, history, current_round, agents)
+        try:
+            with call_context(role="moderator"):
+                llm_response = await self.llm_client.agenerate(prompt, self.model_name_for_api, self.response_length)
+        except LLMRequestError as e:
+            debug_print(f"[DEBUG] Moderator LLM unavailable, using a templated panel question: {e}")
+            return "これまでの議論を踏まえて、皆さんの考えをお聞かせください。"
+        return self._parse_panel_question(llm_response)
+
+    def speaker_for_statement(self, statement, history, agents):
+        """Recovers the agent addressed by an already logged moderator statement (used on resume)."""
+        valid_agent_names = [agent['name'] for agent in agents]
+        match = re.search(r'(AI-[A-Z])', statement)
+        if match and match.group(1) in valid_agent_names:
+            return match.group(1)
+        # Same fallback as decide_next_speaker
+        return self.predict_next_speaker(history, agents)
+
+    def _build_summary_prompt(self, topic, history):
         recent_history = history # history is already recent history from main.py
-        history_text = "\n".join([f"{item['speaker']}: {item['text']}" for item in recent_history])
+        history_text = render_history(recent_history)
         
         prompt = f"""
 あなたは討論の司会者です。以下の主題とこれまでの討論内容を元に、簡潔に要点をまとめてください。
@@ -112,12 +219,71 @@ class ModeratorEngine:
 
 要約:
 """
-        summary = self.llm_client.generate(prompt, self.model_name_for_api, "short") # Force short summary
+        return prompt
+
+    def generate_summary(self, topic, history, max_history_tokens=4000):
+        prompt = self._build_summary_prompt(topic, history)
+        with call_context(role="summary"):
+            summary = self.llm_client.generate(prompt, self.model_name_for_api, "short") # Force short summary
+        return summary
+
+    async def agenerate_summary(self, topic, history, max_history_tokens=4000):
+        prompt = self._build_summary_prompt(topic, history)
+        with call_context(role="summary"):
+            summary = await self.llm_client.agenerate(prompt, self.model_name_for_api, "short") # Force short summary
+        return summary
+
+    def _build_rolling_summary_prompt(self, topic, previous_summary, new_messages):
+        new_history_text = render_history(new_messages)
+
+        system = f"""あなたは討論の司会者です。以下の主題について、これまでの要約に新しい発言の内容を反映し、討論全体の要点をまとめた要約に更新してください。
+
+主題: {topic}"""
+        content = f"""これまでの要約:
+{previous_summary or "（まだありません）"}
+
+新しい発言:
+{new_history_text}
+
+更新後の要約:"""
+        return ChatPrompt(system, [{"role": "user", "content": content}])
+
+    def update_summary(self, topic, state_tracker):
+        """Folds the messages added since the last summary into the rolling summary in state_tracker.
+
+        Only the new messages are sent, so the prompt stays bounded however long the debate runs.
+        """
+        new_messages, upto = state_tracker.messages_since_summary()
+        if not new_messages:
+            return state_tracker.running_summary
+        prompt = self._build_rolling_summary_prompt(topic, state_tracker.running_summary, new_messages)
+        try:
+            with call_context(role="summary"):
+                summary = self.llm_client.generate(prompt, self.model_name_for_api, ROLLING_SUMMARY_LENGTH)
+        except LLMRequestError as e:
+            # Keep the previous summary; the unsummarized messages are folded in next time
+            debug_print(f"[DEBUG] Summary update failed: {e}")
+            return state_tracker.running_summary
+        state_tracker.update_summary(summary, upto)
+        return summary
+
+    async def aupdate_summary(self, topic, state_tracker):
+        new_messages, upto = state_tracker.messages_since_summary()
+        if not new_messages:
+            return state_tracker.running_summary
+        prompt = self._build_rolling_summary_prompt(topic, state_tracker.running_summary, new_messages)
+        try:
+            with call_context(role="summary"):
+                summary = await self.llm_client.agenerate(prompt, self.model_name_for_api, ROLLING_SUMMARY_LENGTH)
+        except LLMRequestError as e:
+            debug_print(f"[DEBUG] Summary update failed: {e}")
+            return state_tracker.running_summary
+        state_tracker.update_summary(summary, upto)
         return summary
 
     def generate_moderator_prompt(self, topic, history, current_round, agents, max_history_tokens=4000):
         recent_history = history # history is already recent history from main.py
-        history_text = "\n".join([f"{item['speaker']}: {item['text']}" for item in recent_history])
+        history_text = render_history(recent_history)
         available_agents = ", ".join([agent['name'] for agent in agents])
         
         prompt_template = """
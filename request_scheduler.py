@@ -0,0 +1,457 @@
+# request_scheduler.py
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from telemetry import separate_usage
+from utils import debug_print
+
+# Defaults for the optional `scheduler:` section of models.yaml
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+
+# Latencies kept per model for the hedging percentile
+LATENCY_WINDOW = 200
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+# Opened by track_failover(); the scheduler notes in it which fallback model answered
+_FAILOVER = contextvars.ContextVar("failover", default=None)
+
+class LLMRequestError(RuntimeError):
+    """Raised when a request fails on its model and on every fallback model."""
+
+@contextlib.contextmanager
+def track_failover():
+    """Yields a dict that gets a "model_key" when a call inside the block was answered by a fallback model."""
+    served = {}
+    token = _FAILOVER.set(served)
+    try:
+        yield served
+    finally:
+        try:
+            _FAILOVER.reset(token)
+        except ValueError:
+            pass # A stream closed from another context (e.g. garbage collected)
+
+def status_code(error):
+    """HTTP status of a provider SDK exception (openai: status_code, google: code), or None."""
+    for attribute in ("status_code", "code"):
+        value = getattr(error, attribute, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(error, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+def retry_after(error):
+    """Seconds the provider asked us to wait (Retry-After / retry-after-ms), or None."""
+    value = getattr(error, "retry_after", None)
+    if value is not None:
+        return float(value)
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds:
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(error):
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES or status >= 500
+    # No status: network-level failures are worth retrying, anything else is a bug or bad request
+    name = type(error).__name__
+    return (isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError))
+            or "Timeout" in name or "Connection" in name)
+
+class TokenBucket:
+    """Refills `per_minute` units per minute, up to a burst of `per_minute`.
+
+    reserve() always takes the units and returns how long the caller must wait
+    for them, so concurrent callers queue up in the order they arrived without
+    needing a lock.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def available(self, amount):
+        self._refill()
+        return self.tokens >= min(amount, self.capacity)
+
+    def reserve(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return max(0.0, -self.tokens / self.rate)
+
+class RateLimiter:
+    """Requests/min and tokens/min buckets, keyed per provider and per model."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.blocked_until = {}
+
+    def configure(self, key, rpm=None, tpm=None):
+        self.buckets[key] = {
+            "requests": TokenBucket(rpm) if rpm else None,
+            "tokens": TokenBucket(tpm) if tpm else None,
+        }
+
+    def _buckets(self, keys, tokens):
+        for key in keys:
+            buckets = self.buckets.get(key, {})
+            if buckets.get("requests") is not None:
+                yield buckets["requests"], 1
+            if buckets.get("tokens") is not None:
+                yield buckets["tokens"], tokens
+
+    def counts_tokens(self, keys):
+        """Whether any tokens/min bucket applies, i.e. whether prompts need counting at all."""
+        return any(self.buckets.get(key, {}).get("tokens") is not None for key in keys)
+
+    def reserve(self, keys, tokens):
+        """Takes one request and `tokens` tokens from every bucket; returns seconds to wait."""
+        now = time.monotonic()
+        wait = max([self.blocked_until.get(key, now) - now for key in keys] + [0.0])
+        for bucket, amount in self._buckets(keys, tokens):
+            wait = max(wait, bucket.reserve(amount))
+        return wait
+
+    def try_reserve(self, keys, tokens):
+        """Like reserve(), but only if nothing has to wait (used for hedged requests)."""
+        now = time.monotonic()
+        if any(self.blocked_until.get(key, now) > now for key in keys):
+            return False
+        buckets = list(self._buckets(keys, tokens))
+        if not all(bucket.available(amount) for bucket, amount in buckets):
+            return False
+        for bucket, amount in buckets:
+            bucket.reserve(amount)
+        return True
+
+    def cooldown(self, keys, seconds):
+        """Holds back every request to `keys` for `seconds` (after a 429)."""
+        until = time.monotonic() + seconds
+        for key in keys:
+            self.blocked_until[key] = max(self.blocked_until.get(key, 0.0), until)
+
+class ScheduledClient:
+    """Wraps a provider client so every call for one model key goes through the RequestScheduler.
+
+    It has the same generate/agenerate/stream/astream interface as the provider
+    clients, but raises LLMRequestError instead of returning partial or error text.
+    """
+
+    def __init__(self, client, scheduler, model_key, model_name, api_type, token_counter,
+                 settings_table, fallback=None):
+        self.client = client
+        self.scheduler = scheduler
+        self.model_key = model_key
+        self.model_name = model_name
+        self.api_type = api_type
+        self.token_counter = token_counter
+        self.settings_table = settings_table
+        self.fallback = fallback
+        self.limit_keys = (("provider", api_type), ("model", model_key))
+
+    def request_tokens(self, prompt, response_length):
+        settings = self.settings_table.get(response_length, self.settings_table["medium"])
+        return self.token_counter.count(prompt) + settings["max_tokens"]
+
+    def generate(self, prompt, model_name, response_length="medium"):
+        return self.scheduler.run(self, prompt, model_name, response_length)
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        return await self.scheduler.arun(self, prompt, model_name, response_length)
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        return self.scheduler.stream(self, prompt, model_name, response_length)
+
+    def astream(self, prompt, model_name, response_length="medium"):
+        return self.scheduler.astream(self, prompt, model_name, response_length)
+
+class RequestScheduler:
+    """Rate limiting, retries, hedging and failover for LLM calls.
+
+    - Calls wait for the requests/min and tokens/min buckets of their provider and model.
+    - Failed calls are retried with jittered exponential backoff; a Retry-After
+      from the provider takes precedence, and a 429 holds back the other callers too.
+    - With hedge_percentile set, an async call still running after that
+      percentile of the model's recent latencies gets a duplicate request;
+      the first to finish wins. Streams are never hedged.
+    - When a model gives up, its `fallback` model key (and that one's fallback) is tried.
+    """
+
+    def __init__(self):
+        self.limiter = RateLimiter()
+        self.clients = {}
+        self.latencies = {}
+        self.random = random.Random()
+        self.configure(None)
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "throttle_seconds": 0.0,
+            "retries": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "failovers": 0,
+            "failures": 0,
+        }
+
+    def configure(self, settings):
+        settings = settings or {}
+        self.max_retries = int(settings.get('max_retries', DEFAULT_MAX_RETRIES))
+        self.base_delay = float(settings.get('base_delay', DEFAULT_BASE_DELAY))
+        self.max_delay = float(settings.get('max_delay', DEFAULT_MAX_DELAY))
+        hedge_percentile = settings.get('hedge_percentile')
+        self.hedge_percentile = float(hedge_percentile) if hedge_percentile is not None else None
+        self.hedge_min_samples = int(settings.get('hedge_min_samples', DEFAULT_HEDGE_MIN_SAMPLES))
+
+    def register(self, scheduled_client):
+        self.clients[scheduled_client.model_key] = scheduled_client
+
+    def _chain(self, target):
+        """The target followed by its fallback models, each at most once."""
+        chain = [target]
+        fallback = target.fallback
+        while fallback is not None and fallback in self.clients and fallback not in [c.model_key for c in chain]:
+            chain.append(self.clients[fallback])
+            fallback = self.clients[fallback].fallback
+        return chain
+
+    def _request_tokens(self, target, prompt, response_length):
+        if not self.limiter.counts_tokens(target.limit_keys):
+            return 0
+        return target.request_tokens(prompt, response_length)
+
+    def _reserve(self, target, tokens):
+        wait = self.limiter.reserve(target.limit_keys, tokens)
+        if wait > 0:
+            self.stats["throttled"] += 1
+            self.stats["throttle_seconds"] += wait
+            debug_print(f"Rate limit: waiting {wait:.2f}s for '{target.model_key}'")
+        return wait
+
+    def _retry_delay(self, target, attempt, error):
+        """Seconds to wait before retrying after `error`, or None to give up on this model."""
+        debug_print(f"Error calling '{target.model_key}' (attempt {attempt + 1}): {error}")
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+            delay = backoff / 2 + self.random.uniform(0, backoff / 2)
+        if status_code(error) == 429:
+            self.limiter.cooldown(target.limit_keys, delay)
+        self.stats["retries"] += 1
+        return delay
+
+    def _record_latency(self, model_key, seconds):
+        self.latencies.setdefault(model_key, collections.deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def hedge_delay(self, model_key):
+        """Latency after which an async call to model_key is hedged, or None."""
+        samples = self.latencies.get(model_key)
+        if self.hedge_percentile is None or not samples or len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return ordered[index]
+
+    def _served_by(self, index, candidate):
+        served = _FAILOVER.get()
+        if index and served is not None:
+            served["model_key"] = candidate.model_key
+
+    def _give_up(self, target, errors):
+        self.stats["failures"] += 1
+        raise LLMRequestError(f"Request to '{target.model_key}' failed: " + "; ".join(errors))
+
+    # --- Blocking calls ---
+
+    def run(self, target, prompt, model_name, response_length):
+        self.stats["requests"] += 1
+        errors = []
+        for index, candidate in enumerate(self._chain(target)):
+            if index:
+                self.stats["failovers"] += 1
+                debug_print(f"Failing over from '{target.model_key}' to '{candidate.model_key}'")
+            name = model_name if index == 0 else candidate.model_name
+            tokens = self._request_tokens(candidate, prompt, response_length)
+            for attempt in range(self.max_retries + 1):
+                time.sleep(self._reserve(candidate, tokens))
+                started_at = time.perf_counter()
+                try:
+                    response = candidate.client.generate(prompt, name, response_length)
+                except Exception as e:
+                    delay = self._retry_delay(candidate, attempt, e)
+                    if delay is None:
+                        errors.append(f"{candidate.model_key}: {type(e).__name__}: {e}")
+                        break
+                    time.sleep(delay)
+                    continue
+                self._record_latency(candidate.model_key, time.perf_counter() - started_at)
+                self._served_by(index, candidate)
+                return response
+        self._give_up(target, errors)
+
+    def stream(self, target, prompt, model_name, response_length):
+        self.stats["requests"] += 1
+        errors = []
+        for index, candidate in enumerate(self._chain(target)):
+            if index:
+                self.stats["failovers"] += 1
+            name = model_name if index == 0 else candidate.model_name
+            tokens = self._request_tokens(candidate, prompt, response_length)
+            for attempt in range(self.max_retries + 1):
+                time.sleep(self._reserve(candidate, tokens))
+                started = False
+                try:
+                    for chunk in candidate.client.stream(prompt, name, response_length):
+                        started = True
+                        yield chunk
+                    self._served_by(index, candidate)
+                    return
+                except Exception as e:
+                    # Chunks already yielded cannot be taken back, so a broken stream is not retried
+                    if started:
+                        self.stats["failures"] += 1
+                        raise LLMRequestError(f"Stream from '{candidate.model_key}' broke off: {e}") from e
+                    delay = self._retry_delay(candidate, attempt, e)
+                    if delay is None:
+                        errors.append(f"{candidate.model_key}: {type(e).__name__}: {e}")
+                        break
+                    time.sleep(delay)
+        self._give_up(target, errors)
+
+    # --- Async calls ---
+
+    async def arun(self, target, prompt, model_name, response_length):
+        self.stats["requests"] += 1
+        errors = []
+        for index, candidate in enumerate(self._chain(target)):
+            if index:
+                self.stats["failovers"] += 1
+                debug_print(f"Failing over from '{target.model_key}' to '{candidate.model_key}'")
+            name = model_name if index == 0 else candidate.model_name
+            tokens = self._request_tokens(candidate, prompt, response_length)
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(self._reserve(candidate, tokens))
+                try:
+                    response = await self._ahedged(candidate, prompt, name, response_length, tokens)
+                    self._served_by(index, candidate)
+                    return response
+                except Exception as e:
+                    delay = self._retry_delay(candidate, attempt, e)
+                    if delay is None:
+                        errors.append(f"{candidate.model_key}: {type(e).__name__}: {e}")
+                        break
+                    await asyncio.sleep(delay)
+        self._give_up(target, errors)
+
+    async def _attempt(self, target, prompt, model_name, response_length):
+        # Each copy of a hedged request reports its own usage, so the loser's tokens are counted too
+        with separate_usage(lambda: target.token_counter.count(prompt)):
+            return await target.client.agenerate(prompt, model_name, response_length)
+
+    async def _ahedged(self, target, prompt, model_name, response_length, tokens):
+        started_at = time.perf_counter()
+        primary = asyncio.ensure_future(self._attempt(target, prompt, model_name, response_length))
+        pending = {primary}
+        try:
+            hedge_delay = self.hedge_delay(target.model_key)
+            if hedge_delay is not None:
+                await asyncio.wait(pending, timeout=hedge_delay)
+                if not primary.done() and self.limiter.try_reserve(target.limit_keys, tokens):
+                    self.stats["hedged"] += 1
+                    debug_print(f"Hedging '{target.model_key}' after {hedge_delay:.2f}s")
+                    pending.add(asyncio.ensure_future(self._attempt(target, prompt, model_name, response_length)))
+
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        self._record_latency(target.model_key, time.perf_counter() - started_at)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # Let the losers unwind, so their usage lands in the call's record before it is closed
+                await asyncio.wait(pending)
+
+    async def astream(self, target, prompt, model_name, response_length):
+        self.stats["requests"] += 1
+        errors = []
+        for index, candidate in enumerate(self._chain(target)):
+            if index:
+                self.stats["failovers"] += 1
+            name = model_name if index == 0 else candidate.model_name
+            tokens = self._request_tokens(candidate, prompt, response_length)
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(self._reserve(candidate, tokens))
+                started = False
+                try:
+                    async for chunk in candidate.client.astream(prompt, name, response_length):
+                        started = True
+                        yield chunk
+                    self._served_by(index, candidate)
+                    return
+                except Exception as e:
+                    if started:
+                        self.stats["failures"] += 1
+                        raise LLMRequestError(f"Stream from '{candidate.model_key}' broke off: {e}") from e
+                    delay = self._retry_delay(candidate, attempt, e)
+                    if delay is None:
+                        errors.append(f"{candidate.model_key}: {type(e).__name__}: {e}")
+                        break
+                    await asyncio.sleep(delay)
+        self._give_up(target, errors)
+
+    def print_report(self):
+        print("\n--- Request Scheduler ---")
+        print(f"Requests: {self.stats['requests']}, Retries: {self.stats['retries']}, "
+              f"Failovers: {self.stats['failovers']}, Failed: {self.stats['failures']}")
+        print(f"Rate-limited: {self.stats['throttled']} waits ({self.stats['throttle_seconds']:.1f}s)")
+        print(f"Hedged: {self.stats['hedged']} (hedge won {self.stats['hedge_wins']})")
+        for model_key in self.latencies:
+            delay = self.hedge_delay(model_key)
+            if delay is not None:
+                print(f"{model_key}: hedging after {delay:.2f}s")
+        print("-------------------------")
@@ -0,0 +1,194 @@
+# response_cache.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from utils import debug_print
+from request_scheduler import track_failover
+from telemetry import report_cache_hit
+
+class CacheMissError(RuntimeError):
+    """Raised in replay mode when a request has no cached response."""
+
+class ResponseCache:
+    """Two-tier (in-memory LRU + SQLite) store for LLM responses.
+
+    Entries are content-addressed by a hash of the provider, model, full prompt
+    and the RESPONSE_LENGTH_SETTINGS entry used for the call.
+    """
+
+    def __init__(self, path=os.path.join('.cache', 'responses.sqlite'), memory_entries=1024,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, response TEXT NOT NULL,"
+            " size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._db.commit()
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(api_type, model_name, prompt, settings):
+        payload = json.dumps(
+            {"api": api_type, "model": model_name, "prompt": prompt, "settings": settings},
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return self._memory[key]
+
+        row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._db.commit()
+        self.hits += 1
+        self.disk_hits += 1
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key, response):
+        self._remember(key, response)
+        size = len(response.encode('utf-8')) + len(key)
+        previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time())
+        )
+        self._disk_bytes += size - (previous[0] if previous else 0)
+        self._evict_disk()
+        self._db.commit()
+
+    def _remember(self, key, response):
+        self._memory[key] = response
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Drop least recently used rows until the store fits in max_disk_bytes
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._memory.pop(key, None)
+                self._disk_bytes -= size
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+        debug_print(f"ResponseCache disk usage: {self._disk_bytes} bytes")
+
+    def close(self):
+        self._db.close()
+
+    def print_report(self):
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        print("\n--- Response Cache ---")
+        print(f"Hits: {self.hits} (disk: {self.disk_hits}), Misses: {self.misses}, Hit rate: {hit_rate:.1f}%")
+        print("----------------------")
+
+class CachedClient:
+    """Wraps an API client so identical requests are served from a ResponseCache.
+
+    With replay=True the wrapped client is never called and a miss raises
+    CacheMissError, which makes reruns fully offline.
+    """
+
+    def __init__(self, client, cache, settings_table, api_type, replay=False):
+        self.client = client
+        self.cache = cache
+        self.settings_table = settings_table
+        self.api_type = api_type
+        self.replay = replay
+
+    def _key(self, prompt, model_name, response_length):
+        settings = self.settings_table.get(response_length, self.settings_table["medium"])
+        return self.cache.make_key(self.api_type, model_name, prompt, settings)
+
+    def _lookup(self, key, model_name):
+        cached = self.cache.get(key)
+        if cached is None and self.replay:
+            raise CacheMissError(f"No cached response for model '{model_name}' (replay mode).")
+        if cached is not None:
+            debug_print(f"Cache hit for model '{model_name}' ({key[:12]})")
+            report_cache_hit()
+        return cached
+
+    def _store(self, key, response, served):
+        # Failed requests raise before reaching here, so only real responses are cached.
+        # A fallback model's answer is not this model's, so --replay must not return it.
+        if served:
+            debug_print(f"Not caching the response of fallback model '{served['model_key']}'")
+            return
+        self.cache.put(key, response)
+
+    def generate(self, prompt, model_name, response_length="medium"):
+        key = self._key(prompt, model_name, response_length)
+        cached = self._lookup(key, model_name)
+        if cached is not None:
+            return cached
+        with track_failover() as served:
+            response = self.client.generate(prompt, model_name, response_length)
+        self._store(key, response, served)
+        return response
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        key = self._key(prompt, model_name, response_length)
+        cached = self._lookup(key, model_name)
+        if cached is not None:
+            return cached
+        with track_failover() as served:
+            response = await self.client.agenerate(prompt, model_name, response_length)
+        self._store(key, response, served)
+        return response
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        key = self._key(prompt, model_name, response_length)
+        cached = self._lookup(key, model_name)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        with track_failover() as served:
+            for chunk in self.client.stream(prompt, model_name, response_length):
+                chunks.append(chunk)
+                yield chunk
+        self._store(key, "".join(chunks), served)
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        key = self._key(prompt, model_name, response_length)
+        cached = self._lookup(key, model_name)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        with track_failover() as served:
+            async for chunk in self.client.astream(prompt, model_name, response_length):
+                chunks.append(chunk)
+                yield chunk
+        self._store(key, "".join(chunks), served)
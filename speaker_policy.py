@@ -0,0 +1,84 @@
+# speaker_policy.py
+
+import random
+import re
+
+class SpeakerPolicy:
+    """Chooses the next speaker locally, without an LLM call.
+
+    Subclasses implement choose(history, agents, current_round), where history is
+    the recent message list and agents the agent configs from agents.yaml.
+    """
+    name = "base"
+
+    def choose(self, history, agents, current_round):
+        raise NotImplementedError
+
+class RoundRobinPolicy(SpeakerPolicy):
+    """The agent after the last speaker (the moderator's fallback behaviour)."""
+    name = "round-robin"
+
+    def choose(self, history, agents, current_round):
+        valid_agent_names = [agent['name'] for agent in agents]
+        for item in reversed(history):
+            if item['speaker'] in valid_agent_names:
+                return valid_agent_names[(valid_agent_names.index(item['speaker']) + 1) % len(valid_agent_names)]
+        return valid_agent_names[0]
+
+class LeastRecentlySpokenPolicy(SpeakerPolicy):
+    """The agent who has gone longest without speaking (never-spoken agents first)."""
+    name = "least-recent"
+
+    def choose(self, history, agents, current_round):
+        last_spoken = {agent['name']: -1 for agent in agents}
+        for index, item in enumerate(history):
+            if item['speaker'] in last_spoken:
+                last_spoken[item['speaker']] = index
+        # min() keeps config order on ties
+        return min(last_spoken, key=last_spoken.get)
+
+class MentionPolicy(SpeakerPolicy):
+    """An agent addressed in the last agent message (e.g. "AI-B さんはどう思いますか"),
+    falling back to the least recently spoken agent."""
+    name = "mention"
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or LeastRecentlySpokenPolicy()
+
+    def choose(self, history, agents, current_round):
+        valid_agent_names = [agent['name'] for agent in agents]
+        for item in reversed(history):
+            if item['speaker'] not in valid_agent_names:
+                continue
+            pattern = "|".join(re.escape(name) for name in valid_agent_names if name != item['speaker'])
+            match = re.search(pattern, item['text']) if pattern else None
+            if match:
+                return match.group(0)
+            break # Only the last agent message counts
+        return self.fallback.choose(history, agents, current_round)
+
+class WeightedRandomPolicy(SpeakerPolicy):
+    """A random agent other than the last speaker, weighted by the optional
+    `weight` entry of each agent in agents.yaml."""
+    name = "weighted-random"
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def choose(self, history, agents, current_round):
+        last_speaker = history[-1]['speaker'] if history else None
+        candidates = [agent for agent in agents if agent['name'] != last_speaker] or agents
+        weights = [float(agent.get('weight', 1.0)) for agent in candidates]
+        return self.random.choices(candidates, weights=weights)[0]['name']
+
+SPEAKER_POLICIES = {
+    RoundRobinPolicy.name: RoundRobinPolicy,
+    LeastRecentlySpokenPolicy.name: LeastRecentlySpokenPolicy,
+    MentionPolicy.name: MentionPolicy,
+    WeightedRandomPolicy.name: WeightedRandomPolicy,
+}
+
+def make_speaker_policy(name):
+    if name not in SPEAKER_POLICIES:
+        raise ValueError(f"Unknown speaker policy '{name}'. Available: {', '.join(SPEAKER_POLICIES)}")
+    return SPEAKER_POLICIES[name]()
@@ -0,0 +1,94 @@
+# speculation.py
+
+import asyncio
+
+from telemetry import call_context, collect_usage
+from utils import debug_print
+
+class Speculator:
+    """Pre-generates agent responses while the moderator is still deciding.
+
+    Up to `max_candidates` agents are started at the beginning of a round,
+    beginning with the moderator's deterministic fallback choice. Once the
+    moderator has picked a speaker, the matching response is used and the
+    others are cancelled (or discarded if they already finished).
+
+    Speculative responses are generated against the history before this
+    round's moderator statement, so the agent does not see the moderator's
+    question. That is the price of overlapping the two calls.
+    """
+
+    def __init__(self, moderator_engine, agent_engine, max_candidates=1):
+        self.moderator_engine = moderator_engine
+        self.agent_engine = agent_engine
+        self.max_candidates = max(1, max_candidates)
+        self.stats = {
+            "rounds": 0,
+            "hits": 0,
+            "misses": 0,
+            "cancelled": 0,
+            "wasted_responses": 0,
+            "wasted_tokens": 0,
+        }
+        # agent name -> token totals of this round's speculative call for that agent
+        self._usage = {}
+
+    def start(self, topic, state_tracker, agent_configs):
+        """Starts speculative responses for the likely next speakers. Returns {agent name: task}."""
+        agent_names = [agent['name'] for agent in agent_configs]
+        predicted = self.moderator_engine.predict_next_speaker(
+            self.moderator_engine.recent_history(state_tracker), agent_configs
+        )
+        # Predicted speaker first, then the rest in speaking order
+        offset = agent_names.index(predicted)
+        candidates = (agent_names[offset:] + agent_names[:offset])[:self.max_candidates]
+
+        tasks = {}
+        self._usage = {}
+        # Tasks copy the context, so telemetry can tell speculative calls (and their cost) apart
+        with call_context(speculative=True):
+            for agent_name in candidates:
+                with collect_usage() as usage:
+                    tasks[agent_name] = asyncio.create_task(self.agent_engine.aget_agent_response(
+                        agent_name, topic, self.agent_engine.recent_history(agent_name, state_tracker)
+                    ))
+                self._usage[agent_name] = usage
+        debug_print(f"Speculating on {candidates}")
+        return tasks
+
+    async def resolve(self, tasks, speaker_name):
+        """Returns the speculative response for speaker_name, or None on a miss.
+
+        The prompt and completion tokens of the discarded and cancelled calls
+        are added to wasted_tokens; a cancelled call's prompt was already sent.
+        """
+        self.stats["rounds"] += 1
+        discarded = [agent_name for agent_name in tasks if agent_name != speaker_name]
+        for agent_name in discarded:
+            task = tasks[agent_name]
+            if task.done() and not task.cancelled() and task.exception() is None:
+                self.stats["wasted_responses"] += 1
+            else:
+                task.cancel()
+                self.stats["cancelled"] += 1
+        if discarded:
+            # Let the cancelled calls unwind, so their usage is recorded before it is added up
+            await asyncio.wait([tasks[agent_name] for agent_name in discarded])
+        for agent_name in discarded:
+            usage = self._usage[agent_name]
+            self.stats["wasted_tokens"] += usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if speaker_name not in tasks:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return await tasks[speaker_name]
+
+    def print_report(self):
+        rounds = self.stats["rounds"]
+        hit_rate = (self.stats["hits"] / rounds * 100) if rounds else 0.0
+        print("\n--- Speculation ---")
+        print(f"Hits: {self.stats['hits']}, Misses: {self.stats['misses']}, Hit rate: {hit_rate:.1f}%")
+        print(f"Cancelled: {self.stats['cancelled']}, Discarded responses: {self.stats['wasted_responses']} "
+              f"(~{self.stats['wasted_tokens']} wasted prompt and completion tokens)")
+        print("-------------------")
@@ -2,47 +2,335 @@
 
 import json
 import os
+import sys
+import tempfile
+from array import array
+from bisect import bisect_left
 from datetime import datetime
 
+from token_counter import DEFAULT_TOKEN_COUNTER, MESSAGE_OVERHEAD_TOKENS, count_message_tokens
+
+class Message:
+    """A single turn. Slotted to keep long conversations compact in memory.
+
+    Supports item access (message['speaker']) so it can be used wherever the
+    old plain-dict history entries were.
+    """
+    __slots__ = ('round', 'speaker', 'text', 'metadata')
+
+    _FIELDS = ('round', 'speaker', 'text')
+
+    def __init__(self, round_num, speaker, text, metadata=None):
+        self.round = round_num
+        self.speaker = sys.intern(speaker)
+        self.text = text
+        # Optional extra log fields, e.g. model and timing of the turn
+        self.metadata = metadata
+
+    def __getitem__(self, key):
+        if key not in self._FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._FIELDS else default
+
+    def to_dict(self):
+        entry = {"round": self.round, "speaker": self.speaker, "text": self.text}
+        if self.metadata:
+            entry.update(self.metadata)
+        return entry
+
+    @classmethod
+    def from_dict(cls, entry):
+        metadata = {key: value for key, value in entry.items() if key not in cls._FIELDS}
+        return cls(entry["round"], entry["speaker"], entry["text"], metadata or None)
+
+class HistoryWindow(list):
+    """List of recent messages; `summary` is the rolling summary of the older discussion, if any."""
+
+    def __init__(self, messages, summary=""):
+        super().__init__(messages)
+        self.summary = summary
+
+def render_history(history):
+    """Returns the "speaker: text" lines used in prompts for a history list."""
+    return "\n".join([f"{item['speaker']}: {item['text']}" for item in history])
+
+def render_history_messages(history):
+    """Returns a history window as chat messages: the rolling summary (if any), then one
+    "speaker: text" user message per turn. New turns only ever append messages."""
+    messages = []
+    summary = getattr(history, 'summary', "")
+    if summary:
+        messages.append({"role": "user", "content": f"これまでの議論の要約:\n{summary}"})
+    for item in history:
+        messages.append({"role": "user", "content": f"{item['speaker']}: {item['text']}"})
+    return messages
+
+class ChatPrompt(str):
+    """A prompt split into a fixed system prefix and an append-only list of chat messages.
+
+    Clients that support chat messages send `system` and `messages` natively,
+    so consecutive requests share a byte-identical prefix that provider-side
+    prompt caching can reuse. The string value is the flattened prompt, so
+    token counting, response cache keys and the mock clients work unchanged.
+    """
+
+    def __new__(cls, system, messages):
+        text = "\n\n".join([system] + [f"[{message['role']}] {message['content']}" for message in messages])
+        prompt = super().__new__(cls, text)
+        prompt.system = system
+        prompt.messages = messages
+        return prompt
+
+class LogWriter:
+    """Append-only JSONL sink that writes each message as it is added.
+
+    The file is flushed every `flush_every` entries (and fsync'ed on each flush
+    if fsync=True), so a crash loses at most the unflushed tail.
+    """
+
+    def __init__(self, path, flush_every=1, fsync=False):
+        self.path = path
+        self.flush_every = max(1, flush_every)
+        self.fsync = fsync
+        self._pending = 0
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._pending = 0
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+def read_log_entries(path):
+    """Reads a (possibly partial) JSONL log, dropping a torn trailing line.
+
+    Returns the entries and the byte length of the valid prefix of the file.
+    """
+    entries = []
+    valid_length = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break # Torn write from a crash
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+            valid_length += len(line)
+    return entries, valid_length
+
+# Messages before the rolling-summary boundary still included verbatim
+SUMMARY_OVERLAP_MESSAGES = 2
+
 class StateTracker:
-    def __init__(self, log_dir='logs'):
+    def __init__(self, log_dir='logs', spill_after=None, token_counters=None, on_message=None):
+        # Messages still held in memory; older ones may have been spilled to disk
         self.discussion_history = []
         self.log_dir = log_dir
         os.makedirs(log_dir, exist_ok=True)
 
-    def add_message(self, round_num, speaker, text):
-        self.discussion_history.append({
-            "round": round_num,
-            "speaker": speaker,
-            "text": text
-        })
+        # model key -> token counter; models sharing a tokenizer share one index
+        self.token_counters = dict(token_counters or {})
+        # tokenizer name -> (counter, running prefix sum of per-message token
+        # counts). Each message is counted once per tokenizer at add_message
+        # time, so a token-budgeted window is found with a binary search.
+        self._cumulative_costs = {}
+        for counter in [DEFAULT_TOKEN_COUNTER] + list(self.token_counters.values()):
+            self._cumulative_costs.setdefault(counter.name, (counter, array('q', [0])))
+
+        self.spill_after = spill_after
+        self._spilled_count = 0
+        self._spill_offsets = array('q')
+        self._spill_file = None
+
+        self.log_writer = None
+        # Called with every added Message (e.g. to stream turns to a daemon client)
+        self.on_message = on_message
+
+        # Rolling summary of messages [0, summary_upto), folded in incrementally
+        self.running_summary = ""
+        self.summary_upto = 0
+        # tokenizer name -> token count of the running summary
+        self._summary_tokens = {}
+
+    def __len__(self):
+        return self._spilled_count + len(self.discussion_history)
+
+    def add_message(self, round_num, speaker, text, metadata=None):
+        message = Message(round_num, speaker, text, metadata)
+        self.discussion_history.append(message)
+        for counter, cumulative in self._cumulative_costs.values():
+            cumulative.append(cumulative[-1] + count_message_tokens(counter, message.speaker, message.text))
+        if self.log_writer is not None:
+            self.log_writer.write(message.to_dict())
+        if self.on_message is not None:
+            self.on_message(message)
+
+        if self.spill_after and len(self.discussion_history) >= 2 * self.spill_after:
+            self._spill(len(self.discussion_history) - self.spill_after)
 
     def get_history(self):
-        return self.discussion_history
-
-    def get_recent_history(self, max_tokens):
-        recent_history = []
-        current_tokens = 0
-        # Iterate in reverse to get the most recent messages first
-        for message in reversed(self.discussion_history):
-            # A very rough estimate: 1 token ~ 4 characters for Japanese
-            message_length = len(message["text"]) + len(message["speaker"]) + 5 # Add some buffer for speaker name and formatting
-            if current_tokens + message_length <= max_tokens:
-                recent_history.append(message)
-                current_tokens += message_length
-            else:
-                break
-        # Return in chronological order
-        return list(reversed(recent_history))
+        if not self._spilled_count:
+            return self.discussion_history
+        return [self._message(i) for i in range(self._spilled_count)] + self.discussion_history
+
+    def count_tokens(self, text, model_key=None):
+        return self._counter(model_key).count(text)
+
+    def get_recent_history(self, max_tokens, model_key=None, use_summary=False):
+        """Returns the most recent messages that fit in max_tokens.
+
+        Tokens are counted with the tokenizer of model_key (see token_counter.py),
+        or the offline estimate if no model is given. With use_summary=True and a
+        rolling summary available, messages already covered by the summary are
+        left out (apart from SUMMARY_OVERLAP_MESSAGES for continuity) and the
+        summary is attached to the window instead.
+        """
+        counter = self._counter(model_key)
+        cumulative = self._cumulative(counter)
+        end = len(self)
+        summary = ""
+        budget = max_tokens
+        if use_summary and self.running_summary:
+            summary = self.running_summary
+            # The summary is sent in the same prompt, so it comes out of the same budget
+            budget = max(0, max_tokens - self._summary_token_count(counter))
+        # Smallest start whose suffix (start..end) fits in the budget
+        start = bisect_left(cumulative, cumulative[end] - budget, 0, end + 1)
+        if summary:
+            start = min(max(start, self.summary_upto - SUMMARY_OVERLAP_MESSAGES), end)
+        return HistoryWindow([self._message(i) for i in range(start, end)], summary)
+
+    def messages_since_summary(self):
+        """Returns (messages not yet folded into the rolling summary, index they end at)."""
+        end = len(self)
+        return [self._message(i) for i in range(self.summary_upto, end)], end
 
-    def save_logs(self, topic):
+    def update_summary(self, summary, upto):
+        if upto >= self.summary_upto:
+            self.running_summary = summary
+            self.summary_upto = upto
+            self._summary_tokens = {}
+            if self.log_writer is not None:
+                # Logged so that --resume continues from this summary instead of
+                # folding the whole history into one prompt again
+                self.log_writer.write(self._summary_entry())
+
+    def _summary_entry(self):
+        return {"summary": self.running_summary, "summary_upto": self.summary_upto}
+
+    def _summary_token_count(self, counter):
+        count = self._summary_tokens.get(counter.name)
+        if count is None:
+            count = counter.count(self.running_summary) + MESSAGE_OVERHEAD_TOKENS
+            self._summary_tokens[counter.name] = count
+        return count
+
+    def _counter(self, model_key):
+        return self.token_counters.get(model_key, DEFAULT_TOKEN_COUNTER)
+
+    def _cumulative(self, counter):
+        if counter.name not in self._cumulative_costs:
+            # Tokenizer seen for the first time: count the existing messages once
+            cumulative = array('q', [0])
+            for index in range(len(self)):
+                message = self._message(index)
+                cumulative.append(cumulative[-1] + count_message_tokens(counter, message.speaker, message.text))
+            self._cumulative_costs[counter.name] = (counter, cumulative)
+        return self._cumulative_costs[counter.name][1]
+
+    def _message(self, index):
+        if index >= self._spilled_count:
+            return self.discussion_history[index - self._spilled_count]
+        self._spill_file.seek(self._spill_offsets[index])
+        return Message.from_dict(json.loads(self._spill_file.readline()))
+
+    def _spill(self, count):
+        """Moves the oldest `count` in-memory messages to a temporary file."""
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile(mode='w+b', dir=self.log_dir)
+        self._spill_file.seek(0, os.SEEK_END)
+        for message in self.discussion_history[:count]:
+            self._spill_offsets.append(self._spill_file.tell())
+            self._spill_file.write(json.dumps(message.to_dict(), ensure_ascii=False).encode('utf-8') + b'\n')
+        self._spill_file.flush()
+        del self.discussion_history[:count]
+        self._spilled_count += count
+
+    def _log_path(self, topic, suffix=None):
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         # Sanitize topic for filename
         sanitized_topic = ''.join(c for c in topic if c.isalnum() or c in [' ', '_']).replace(' ', '_')
         filename = f"debate_{sanitized_topic}_{timestamp}.jsonl"
+        if suffix:
+            # Keeps filenames unique when several debates finish within the same second
+            filename = f"debate_{sanitized_topic}_{timestamp}_{suffix}.jsonl"
         filepath = os.path.join(self.log_dir, filename)
+        # Never append to a log from another run started within the same second
+        base, extension = os.path.splitext(filepath)
+        counter = 1
+        while os.path.exists(filepath):
+            filepath = f"{base}-{counter}{extension}"
+            counter += 1
+        return filepath
+
+    def start_log(self, topic, suffix=None, flush_every=1, fsync=False):
+        """Starts streaming every added message to a new JSONL log file."""
+        filepath = self._log_path(topic, suffix)
+        self.log_writer = LogWriter(filepath, flush_every, fsync)
+        for index in range(len(self)):
+            self.log_writer.write(self._message(index).to_dict())
+        if self.running_summary:
+            self.log_writer.write(self._summary_entry())
+        return filepath
+
+    def resume_log(self, filepath, flush_every=1, fsync=False):
+        """Reloads a partial log written by start_log and keeps appending to it.
+
+        Returns the number of messages restored. The latest logged rolling
+        summary is restored too, so summarizing continues where it left off.
+        """
+        entries, valid_length = read_log_entries(filepath)
+        with open(filepath, 'r+b') as f:
+            f.truncate(valid_length)
+        restored = 0
+        for entry in entries:
+            if "summary" in entry and "speaker" not in entry:
+                self.update_summary(entry["summary"], entry["summary_upto"])
+                continue
+            message = Message.from_dict(entry)
+            self.add_message(message.round, message.speaker, message.text, message.metadata)
+            restored += 1
+        self.log_writer = LogWriter(filepath, flush_every, fsync)
+        return restored
+
+    def close_log(self):
+        if self.log_writer is not None:
+            self.log_writer.close()
+
+    def save_logs(self, topic, suffix=None):
+        if self.log_writer is not None:
+            # Messages were already appended as they were added
+            self.log_writer.close()
+            print(f"Discussion logs saved to {self.log_writer.path}")
+            return
 
+        filepath = self._log_path(topic, suffix)
         with open(filepath, 'w', encoding='utf-8') as f:
-            for entry in self.discussion_history:
-                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            for index in range(len(self)):
+                f.write(json.dumps(self._message(index).to_dict(), ensure_ascii=False) + '\n')
         print(f"Discussion logs saved to {filepath}")
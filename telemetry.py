@@ -0,0 +1,362 @@
+# telemetry.py
+
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import time
+
+# Fields (role, round, speaker, ...) attached to every call made in this context.
+# asyncio tasks copy the context when they are created, so a summary task
+# started in round 3 is still attributed to round 3.
+_CALL_CONTEXT = contextvars.ContextVar("call_context", default={})
+
+# The record of the call in progress, filled in by the provider clients via report_usage()
+_CURRENT_CALL = contextvars.ContextVar("current_call", default=None)
+
+# Totals opened by collect_usage(); every call recorded in this context is added to each
+_USAGE_TOTALS = contextvars.ContextVar("usage_totals", default=())
+
+# Latencies kept per series for the quantiles in the report and the Prometheus file
+LATENCY_WINDOW = 1000
+
+PROMETHEUS_PREFIX = "board_llm"
+
+@contextlib.contextmanager
+def call_context(**fields):
+    """Attaches fields to every LLM call made inside the block, e.g. call_context(role="agent")."""
+    token = _CALL_CONTEXT.set({**_CALL_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _CALL_CONTEXT.reset(token)
+
+def report_usage(provider, model_name, prompt_tokens, completion_tokens, cached_tokens=0):
+    """Called by provider clients with the usage the API returned for the current call."""
+    record = _CURRENT_CALL.get()
+    if record is not None:
+        record.update(provider=provider, model_name=model_name, prompt_tokens=prompt_tokens,
+                      completion_tokens=completion_tokens, cached_tokens=cached_tokens or 0, estimated=False)
+
+@contextlib.contextmanager
+def separate_usage(count_prompt_tokens):
+    """Gives one of several concurrent requests for the current call (a hedged
+    duplicate) its own usage, which is added to the call's record on exit
+    instead of overwriting what the other request reported.
+
+    A request cancelled before the provider reported anything is counted with
+    count_prompt_tokens(), since its prompt was already sent.
+    """
+    record = _CURRENT_CALL.get()
+    if record is None:
+        yield
+        return
+    usage = {}
+    token = _CURRENT_CALL.set(usage)
+    try:
+        yield
+    except BaseException as e:
+        if not usage and not isinstance(e, Exception):
+            record["prompt_tokens"] += count_prompt_tokens()
+        raise
+    finally:
+        _CURRENT_CALL.reset(token)
+        if "prompt_tokens" in usage:
+            for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                record[key] += usage[key]
+            record.update(provider=usage["provider"], model_name=usage["model_name"], estimated=False)
+
+@contextlib.contextmanager
+def collect_usage():
+    """Yields a dict that sums the tokens of every call recorded inside the block,
+    including calls in tasks created inside it (they copy the context)."""
+    totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    token = _USAGE_TOTALS.set(_USAGE_TOTALS.get() + (totals,))
+    try:
+        yield totals
+    finally:
+        _USAGE_TOTALS.reset(token)
+
+def report_cache_hit():
+    record = _CURRENT_CALL.get()
+    if record is not None:
+        record["cache_hit"] = True
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def _labels(labels):
+    return ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels.items())
+
+class Telemetry:
+    """Collects one record per LLM call and aggregates them per (provider, model, role, status).
+
+    Records are appended to a JSONL file as they happen; the aggregates feed
+    the end-of-run table and a Prometheus textfile (node_exporter format).
+    """
+
+    def __init__(self):
+        self.prices = {}
+        self.series = {}
+        self.round_times = []
+        self.metrics_file = None
+        self.prometheus_path = None
+
+    def configure(self, models_config):
+        """Reads per-model prices (USD per 1M tokens) from models.yaml, keyed by (api, provider model name)."""
+        self.prices = {}
+        for details in models_config['models'].values():
+            if details.get('prices'):
+                self.prices[(details['api'], details['name'])] = details['prices']
+
+    def open(self, metrics_path=None, prometheus_path=None):
+        if metrics_path:
+            os.makedirs(os.path.dirname(metrics_path) or '.', exist_ok=True)
+            self.metrics_file = open(metrics_path, 'a', encoding='utf-8')
+        self.prometheus_path = prometheus_path
+
+    def cost(self, record):
+        if record.get("cache_hit"):
+            return 0.0
+        prices = self.prices.get((record["provider"], record["model_name"]))
+        if not prices:
+            return 0.0
+        cached = record["cached_tokens"]
+        return ((record["prompt_tokens"] - cached) * prices.get('input', 0.0)
+                + cached * prices.get('cached_input', prices.get('input', 0.0))
+                + record["completion_tokens"] * prices.get('output', 0.0)) / 1_000_000
+
+    @contextlib.contextmanager
+    def measure(self, model_key, provider, model_name):
+        """Times one call and records it; the client fills in usage with report_usage()."""
+        record = {
+            "ts": round(time.time(), 3),
+            **_CALL_CONTEXT.get(),
+            "model": model_key,
+            "provider": provider,
+            "model_name": model_name,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "estimated": True,
+            "cache_hit": False,
+        }
+        token = _CURRENT_CALL.set(record)
+        started_at = time.perf_counter()
+        try:
+            yield record
+            record["status"] = "ok"
+        except BaseException as e:
+            record["status"] = "cancelled" if not isinstance(e, Exception) else "error"
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            try:
+                _CURRENT_CALL.reset(token)
+            except ValueError:
+                pass # A stream closed from another context (e.g. garbage collected)
+            record["latency"] = round(time.perf_counter() - started_at, 4)
+            self.add(record)
+            if not record["cache_hit"]:
+                for totals in _USAGE_TOTALS.get():
+                    totals["calls"] += 1
+                    totals["prompt_tokens"] += record["prompt_tokens"]
+                    totals["completion_tokens"] += record["completion_tokens"]
+
+    def add(self, record):
+        record["cost"] = round(self.cost(record), 8)
+        key = (record["provider"], record["model"], record.get("role", "other"), record["status"])
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                "cache_hits": 0, "cost": 0.0, "latency_sum": 0.0,
+                "latencies": collections.deque(maxlen=LATENCY_WINDOW),
+            }
+        series["calls"] += 1
+        series["prompt_tokens"] += record["prompt_tokens"]
+        series["completion_tokens"] += record["completion_tokens"]
+        series["cached_tokens"] += record["cached_tokens"]
+        series["cache_hits"] += int(record["cache_hit"])
+        series["cost"] += record["cost"]
+        series["latency_sum"] += record["latency"]
+        series["latencies"].append(record["latency"])
+        if self.metrics_file is not None:
+            self.metrics_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.metrics_file.flush()
+
+    @contextlib.contextmanager
+    def track_round(self, round_num):
+        """Attributes the calls inside the block to round_num and records the round's duration."""
+        started_at = time.perf_counter()
+        with call_context(round=round_num):
+            yield
+            self.record_round(round_num, time.perf_counter() - started_at)
+
+    def record_round(self, round_num, seconds):
+        self.round_times.append(seconds)
+        if self.metrics_file is not None:
+            entry = {"ts": round(time.time(), 3), "type": "round", **_CALL_CONTEXT.get(),
+                     "round": round_num, "seconds": round(seconds, 4)}
+            self.metrics_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.metrics_file.flush()
+
+    def write_prometheus(self, path=None):
+        path = path or self.prometheus_path
+        if not path:
+            return
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{{{_labels(labels)}}} {value}")
+
+        def labels_of(key, **extra):
+            provider, model, role, status = key
+            return dict(provider=provider, model=model, role=role, status=status, **extra)
+
+        metric("calls_total", "counter", "LLM calls.",
+               [(labels_of(key), s["calls"]) for key, s in self.series.items()])
+        metric("tokens_total", "counter", "Tokens sent and generated.",
+               [(labels_of(key, type=kind), s[f"{kind}_tokens"])
+                for key, s in self.series.items() for kind in ("prompt", "completion", "cached")])
+        metric("cost_usd_total", "counter", "Estimated cost from the prices in models.yaml.",
+               [(labels_of(key), round(s["cost"], 8)) for key, s in self.series.items()])
+        latency_samples = []
+        for key, s in self.series.items():
+            for quantile in (0.5, 0.9, 0.99):
+                latency_samples.append((labels_of(key, quantile=quantile),
+                                        round(_percentile(s["latencies"], quantile * 100), 4)))
+        lines.append(f"# HELP {PROMETHEUS_PREFIX}_latency_seconds Call latency including retries.")
+        lines.append(f"# TYPE {PROMETHEUS_PREFIX}_latency_seconds summary")
+        for labels, value in latency_samples:
+            lines.append(f"{PROMETHEUS_PREFIX}_latency_seconds{{{_labels(labels)}}} {value}")
+        for key, s in self.series.items():
+            lines.append(f"{PROMETHEUS_PREFIX}_latency_seconds_sum{{{_labels(labels_of(key))}}} {round(s['latency_sum'], 4)}")
+            lines.append(f"{PROMETHEUS_PREFIX}_latency_seconds_count{{{_labels(labels_of(key))}}} {s['calls']}")
+
+        # Written to a temporary file and renamed, so a scraper never reads half a file
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary_path, path)
+
+    def close(self):
+        self.write_prometheus()
+        if self.metrics_file is not None:
+            self.metrics_file.close()
+            self.metrics_file = None
+
+    def print_report(self):
+        if not self.series:
+            return
+        print("\n--- LLM Calls ---")
+        print(f"{'role':<10}{'model':<20}{'calls':>6}{'errors':>7}{'prompt':>9}{'cached':>9}{'compl.':>8}"
+              f"{'avg s':>8}{'p90 s':>8}{'cost $':>11}")
+        rows = {}
+        for (provider, model, role, status), s in self.series.items():
+            row = rows.setdefault((role, model), {"calls": 0, "errors": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                                                  "completion_tokens": 0, "cost": 0.0, "latencies": []})
+            row["calls"] += s["calls"]
+            if status == "error":
+                row["errors"] += s["calls"]
+            row["prompt_tokens"] += s["prompt_tokens"]
+            row["cached_tokens"] += s["cached_tokens"]
+            row["completion_tokens"] += s["completion_tokens"]
+            row["cost"] += s["cost"]
+            row["latencies"].extend(s["latencies"])
+        for (role, model), row in sorted(rows.items()):
+            average = sum(row["latencies"]) / len(row["latencies"]) if row["latencies"] else 0.0
+            print(f"{role:<10}{model:<20}{row['calls']:>6}{row['errors']:>7}{row['prompt_tokens']:>9}"
+                  f"{row['cached_tokens']:>9}{row['completion_tokens']:>8}{average:>8.2f}{_percentile(row['latencies'], 90):>8.2f}"
+                  f"{row['cost']:>11.5f}")
+        total_cost = sum(row["cost"] for row in rows.values())
+        total_calls = sum(row["calls"] for row in rows.values())
+        print(f"{'total':<30}{total_calls:>6}{'':>57}{total_cost:>11.5f}")
+        prompt_tokens = sum(row["prompt_tokens"] for row in rows.values())
+        if prompt_tokens:
+            cached_tokens = sum(row["cached_tokens"] for row in rows.values())
+            print(f"Prompt tokens served from the provider's prompt cache: {cached_tokens / prompt_tokens * 100:.1f}%")
+        if any(s["prompt_tokens"] and not s["cost"] for s in self.series.values()) and not self.prices:
+            print("(No prices in models.yaml, so costs are 0.)")
+        if self.round_times:
+            print(f"Rounds: {len(self.round_times)}, avg {sum(self.round_times) / len(self.round_times):.2f}s, "
+                  f"p90 {_percentile(self.round_times, 90):.2f}s")
+        print("-----------------")
+
+class MeteredClient:
+    """Wraps a client (the outermost layer) and records every call with Telemetry.
+
+    When the provider does not report usage (the DeepSeek mock, cache hits),
+    tokens are estimated with the model's token counter and marked estimated.
+    """
+
+    def __init__(self, client, telemetry, model_key, api_type, model_name, token_counter):
+        self.client = client
+        self.telemetry = telemetry
+        self.model_key = model_key
+        self.api_type = api_type
+        self.model_name = model_name
+        self.token_counter = token_counter
+
+    def _estimate(self, record, prompt, response):
+        if record["estimated"]:
+            # Added, not set: a cancelled hedged duplicate may already have counted its prompt
+            record["prompt_tokens"] += self.token_counter.count(prompt)
+            record["completion_tokens"] += self.token_counter.count(response)
+
+    def _estimate_cancelled(self, record, prompt, response):
+        # A cancelled call (a discarded speculative answer, an abandoned stream) has
+        # already sent its prompt; count it unless the provider or a hedged copy did
+        if record["estimated"] and not record["prompt_tokens"]:
+            self._estimate(record, prompt, response)
+
+    def generate(self, prompt, model_name, response_length="medium"):
+        with self.telemetry.measure(self.model_key, self.api_type, model_name) as record:
+            response = self.client.generate(prompt, model_name, response_length)
+            self._estimate(record, prompt, response)
+        return response
+
+    async def agenerate(self, prompt, model_name, response_length="medium"):
+        with self.telemetry.measure(self.model_key, self.api_type, model_name) as record:
+            try:
+                response = await self.client.agenerate(prompt, model_name, response_length)
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    self._estimate_cancelled(record, prompt, "")
+                raise
+            self._estimate(record, prompt, response)
+        return response
+
+    def stream(self, prompt, model_name, response_length="medium"):
+        chunks = []
+        with self.telemetry.measure(self.model_key, self.api_type, model_name) as record:
+            started_at = time.perf_counter()
+            for chunk in self.client.stream(prompt, model_name, response_length):
+                if not chunks:
+                    record["ttft"] = round(time.perf_counter() - started_at, 4)
+                chunks.append(chunk)
+                yield chunk
+            self._estimate(record, prompt, "".join(chunks))
+
+    async def astream(self, prompt, model_name, response_length="medium"):
+        chunks = []
+        with self.telemetry.measure(self.model_key, self.api_type, model_name) as record:
+            started_at = time.perf_counter()
+            try:
+                async for chunk in self.client.astream(prompt, model_name, response_length):
+                    if not chunks:
+                        record["ttft"] = round(time.perf_counter() - started_at, 4)
+                    chunks.append(chunk)
+                    yield chunk
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    self._estimate_cancelled(record, prompt, "".join(chunks))
+                raise
+            self._estimate(record, prompt, "".join(chunks))
@@ -0,0 +1,84 @@
+# token_counter.py
+
+import math
+import re
+
+from utils import debug_print
+
+# Everything below the CJK blocks; removing it leaves only the CJK characters
+_NON_CJK = re.compile('[\u0000-\u2e7f]+')
+
+class EstimateTokenCounter:
+    """Fast offline estimate, used when no model-specific tokenizer is available.
+
+    CJK characters are counted as roughly one token each and other text as
+    about four characters per token, which is much closer to real BPE counts
+    for Japanese than a plain character count.
+    """
+
+    def __init__(self, name="estimate", cjk_tokens_per_char=1.0, chars_per_token=4.0):
+        self.name = name
+        self.cjk_tokens_per_char = cjk_tokens_per_char
+        self.chars_per_token = chars_per_token
+
+    def count(self, text):
+        cjk = len(_NON_CJK.sub('', text))
+        other = len(text) - cjk
+        return math.ceil(cjk * self.cjk_tokens_per_char + other / self.chars_per_token)
+
+class TiktokenTokenCounter:
+    """Exact counts for OpenAI models, using the optional tiktoken package."""
+
+    def __init__(self, model_name):
+        import tiktoken
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.name = f"tiktoken:{self.encoding.name}"
+
+    def count(self, text):
+        return len(self.encoding.encode(text))
+
+def _openai_counter(model_name):
+    try:
+        return TiktokenTokenCounter(model_name)
+    except Exception as e:
+        # tiktoken missing, or its encoding file cannot be downloaded (offline)
+        debug_print(f"tiktoken unavailable ({e}), falling back to token estimate")
+        return EstimateTokenCounter()
+
+# Factories keyed by the `api` (or explicit `tokenizer`) entry in models.yaml.
+# Each takes the provider model name and returns an object with `name` and `count(text)`.
+TOKEN_COUNTER_FACTORIES = {
+    "openai": _openai_counter,
+    # Gemini's count_tokens is a network call, so use an offline estimate tuned
+    # for its SentencePiece vocabulary instead.
+    "gemini": lambda model_name: EstimateTokenCounter("estimate:gemini", cjk_tokens_per_char=0.8),
+    "estimate": lambda model_name: EstimateTokenCounter(),
+}
+
+DEFAULT_TOKEN_COUNTER = EstimateTokenCounter()
+
+# Overhead per history line for the speaker prefix and newline
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_counters = {}
+
+def register_token_counter(key, factory):
+    TOKEN_COUNTER_FACTORIES[key] = factory
+    _counters.clear()
+
+def get_token_counter(model_details):
+    """Returns the (shared) token counter for a models.yaml entry."""
+    key = model_details.get('tokenizer', model_details['api'])
+    model_name = model_details['name']
+    counter = _counters.get((key, model_name))
+    if counter is None:
+        factory = TOKEN_COUNTER_FACTORIES.get(key)
+        counter = factory(model_name) if factory else DEFAULT_TOKEN_COUNTER
+        _counters[(key, model_name)] = counter
+    return counter
+
+def count_message_tokens(counter, speaker, text):
+    return counter.count(speaker) + counter.count(text) + MESSAGE_OVERHEAD_TOKENS